@@ -0,0 +1,180 @@
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pydicom import read_file
+from pydicom.errors import InvalidDicomError
+from Cache import MaskCache
+from Frame import Frame, DEFER_SIZE
+from Masks import build_rois
+from Volume import Volume
+
+FIELDS = ("patient", "structure_set", "roi", "min", "max", "mean", "std", "median", "volume")
+
+
+def find_patients(root):
+    for directory, _, files in os.walk(root):
+        if any(x.lower().endswith(".dcm") for x in files):
+            yield os.path.relpath(directory, root)
+
+
+def read_study(directory):
+    # CT slices grouped by series, and the paths of the RT structure sets.
+    series = {}
+    structures = []
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        if not os.path.isfile(path):
+            continue
+        try:
+            dataset = read_file(path, defer_size=DEFER_SIZE)
+        except (InvalidDicomError, OSError):
+            continue
+        modality = dataset.get("Modality")
+        if modality == "RTSTRUCT":
+            structures.append(path)
+        elif modality == "CT" and "PixelData" in dataset:
+            series.setdefault(dataset.get("SeriesInstanceUID"), []).append(dataset)
+    return series, structures
+
+
+def referenced_series(contour_frame, series):
+    # The CT series the structure set references, else the one holding a referenced slice, else the only series in
+    # the referenced frame of reference; linked like StudyIndex.series.
+    references = contour_frame.file.get("ReferencedFrameOfReferenceSequence", [])
+    slices = set()
+    for reference in references:
+        for study in reference.get("RTReferencedStudySequence", []):
+            for referenced in study.get("RTReferencedSeriesSequence", []):
+                if referenced.get("SeriesInstanceUID") in series:
+                    return series[referenced.SeriesInstanceUID]
+                for image in referenced.get("ContourImageSequence", []):
+                    slices.add(image.get("ReferencedSOPInstanceUID"))
+    for datasets in series.values():
+        if any(x.get("SOPInstanceUID") in slices for x in datasets):
+            return datasets
+
+    frames = {reference.get("FrameOfReferenceUID") for reference in references}
+    candidates = [x for x in series.values() if x[0].get("FrameOfReferenceUID") in frames]
+    if len(candidates) == 1:
+        return candidates[0]
+    if not references and len(series) == 1:
+        return next(iter(series.values()))
+    return None
+
+
+def process_patient(root, patient, cache_directory=None):
+    series, structures = read_study(os.path.join(root, patient))
+    cache = MaskCache(cache_directory) if cache_directory is not None else None
+    rows = []
+    volumes = {}
+    for path in structures:
+        contour_frame = Frame(path)
+        datasets = referenced_series(contour_frame, series)
+        if datasets is None:
+            continue
+        key = id(datasets)
+        if key not in volumes:
+            volumes[key] = Volume(datasets)
+            for n in range(len(volumes[key])):
+                volumes[key].read_slice(n)
+        volume = volumes[key]
+        volume.contours, volume.masks = {}, {}
+
+        properties = build_rois(contour_frame, volume, cache)
+        for name in contour_frame.contours_names:
+            values = properties[name].values()
+            rows.append({"patient": patient, "structure_set": os.path.basename(path), "roi": name, **values})
+    return rows
+
+
+def read_done(path):
+    if not os.path.isfile(path):
+        return set()
+    with open(path, encoding="utf-8") as file:
+        return {line.rstrip("\n") for line in file if line.strip()}
+
+
+def drop_unfinished(path, done):
+    # Rows of patients that were being written when a previous run stopped are removed before resuming.
+    if not os.path.isfile(path):
+        return
+    with open(path, newline="", encoding="utf-8") as file:
+        rows = [row for row in csv.DictReader(file) if row["patient"] in done]
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_parquet(csv_path, output):
+    try:
+        import pandas
+    except ImportError:
+        print(f"pandas with pyarrow is required for Parquet output, results are in {csv_path}", file=sys.stderr)
+        return False
+    pandas.read_csv(csv_path).to_parquet(output, index=False)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute ROI statistics for every patient folder under a directory.")
+    parser.add_argument("root", help="directory tree with one folder of DICOM files per patient")
+    parser.add_argument("-o", "--output", default="statistics.csv", help="output .csv or .parquet file")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--cache", nargs="?", const="", default=None, metavar="DIRECTORY",
+                        help="reuse rasterized masks from the on-disk cache (default: user cache directory)")
+    parser.add_argument("--restart", action="store_true", help="ignore the results of a previous run")
+    args = parser.parse_args(argv)
+
+    parquet = args.output.lower().endswith(".parquet")
+    csv_path = args.output + ".partial.csv" if parquet else args.output
+    done_path = args.output + ".done"
+    cache_directory = None
+    if args.cache is not None:
+        cache_directory = args.cache or MaskCache().directory
+
+    if args.restart:
+        for path in (csv_path, done_path):
+            if os.path.isfile(path):
+                os.remove(path)
+    done = read_done(done_path)
+    drop_unfinished(csv_path, done)
+
+    patients = [x for x in find_patients(args.root) if x not in done]
+    print(f"{len(done)} patients already done, {len(patients)} to process", file=sys.stderr)
+
+    new_file = not os.path.isfile(csv_path)
+    with open(csv_path, "a", newline="", encoding="utf-8") as output, \
+            open(done_path, "a", encoding="utf-8") as done_file, \
+            ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        writer = csv.DictWriter(output, FIELDS)
+        if new_file:
+            writer.writeheader()
+        futures = {executor.submit(process_patient, args.root, x, cache_directory): x for x in patients}
+        try:
+            for i, future in enumerate(as_completed(futures), 1):
+                patient = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as error:
+                    print(f"[{i}/{len(patients)}] {patient}: failed: {error}", file=sys.stderr)
+                    continue
+                writer.writerows(rows)
+                output.flush()
+                done_file.write(patient + "\n")
+                done_file.flush()
+                print(f"[{i}/{len(patients)}] {patient}: {len(rows)} ROIs", file=sys.stderr)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            print("Interrupted, run again with the same arguments to resume", file=sys.stderr)
+            return 130
+
+    if parquet and not write_parquet(csv_path, args.output):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import sys
+import numpy as np
+from Masks import HuAccumulator, SparseMask
+
+CACHE_SIZE = 2 * 1024 ** 3
+ACCUMULATOR_FIELDS = HuAccumulator.STATE + ("offset",)
+MASK_FIELDS = ("slices", "boxes", "bits")
+# Part of every key; raise it when rasterization changes so masks cached by older versions are not reused.
+CACHE_VERSION = 2
+
+
+def cache_directory():
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "MaksContours")
+
+
+class MaskCache:
+    def __init__(self, directory=None, max_size=CACHE_SIZE):
+        self.directory = directory if directory is not None else cache_directory()
+        self.max_size = max_size
+
+    def key(self, contour_frame, volume):
+        # The RT struct is hashed by content; the CT series by its slice UIDs, files and geometry.
+        digest = hashlib.sha1(f"version {CACHE_VERSION}".encode())
+        with open(contour_frame.file.filename, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        for dataset in volume.datasets:
+            stat = os.stat(dataset.filename)
+            digest.update(f"{dataset.SOPInstanceUID}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        for array in (volume.origins, volume.orientations, volume.spacings, np.array(volume.shape)):
+            digest.update(np.ascontiguousarray(array).tobytes())
+
+        rt_uid = contour_frame.file.SOPInstanceUID
+        series_uid = volume.datasets[0].get("SeriesInstanceUID", "")
+        return f"{rt_uid}_{series_uid}", digest.hexdigest()
+
+    def path(self, key):
+        prefix, digest = key
+        return os.path.join(self.directory, f"{prefix}_{digest[:16]}.npz")
+
+    def load(self, key, names, shape):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if list(data["names"]) != list(names) or tuple(data["shape"]) != tuple(shape):
+                    return None
+                masks = {name: SparseMask.from_state(shape, {field: data[f"{field}_{i}"] for field in MASK_FIELDS})
+                         for i, name in enumerate(names)}
+                accumulators = {name: HuAccumulator.from_state({x: data[f"{x}_{i}"] for x in ACCUMULATOR_FIELDS})
+                                for i, name in enumerate(names)}
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(path)
+        return masks, accumulators
+
+    def save(self, key, names, shape, masks, accumulators):
+        os.makedirs(self.directory, exist_ok=True)
+        self.invalidate(key)
+
+        arrays = {"names": np.array(names, dtype=str), "shape": np.array(shape)}
+        for i, name in enumerate(names):
+            for field, value in {**accumulators[name].state(), **masks[name].state()}.items():
+                arrays[f"{field}_{i}"] = value
+
+        path = self.path(key)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(temporary, path)
+        self.evict()
+
+    def invalidate(self, key):
+        # Entries for the same RT struct and CT series with another content hash are stale.
+        prefix, _ = key
+        current = os.path.basename(self.path(key))
+        for entry in os.listdir(self.directory):
+            if entry.startswith(prefix + "_") and entry.endswith(".npz") and entry != current:
+                os.remove(os.path.join(self.directory, entry))
+
+    def evict(self):
+        entries = [os.path.join(self.directory, x) for x in os.listdir(self.directory) if x.endswith(".npz")]
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(x) for x in entries)
+        while total > self.max_size and len(entries) > 1:
+            oldest = entries.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
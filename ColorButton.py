@@ -16,6 +16,10 @@ class ColorButton(QPushButton):
         self.setStyleSheet(f"background-color: {self.color.name()}; color: white")
         self.clicked.connect(self.open_color_dialog)
 
+    def set_color(self, color):
+        self.color = color
+        self.setStyleSheet(f"background-color: {self.color.name()}; color: white")
+
     def open_color_dialog(self):
         self.color = QColorDialog.getColor()
         if self.color.isValid():
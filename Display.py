@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from PySide6.QtCore import QRunnable
+from Volume import AXIAL
+
+CACHE_SLICES = 64
+PREFETCH_DISTANCE = 2
+
+
+class RenderSlice(QRunnable):
+    def __init__(self, display, n, axis=AXIAL):
+        super().__init__()
+        self.display = display
+        self.n = n
+        self.axis = axis
+
+    def run(self):
+        self.display.slice(self.n, self.axis)
+        with self.display.lock:
+            self.display.pending.discard((self.axis, self.n))
+
+
+class Display:
+    def __init__(self, volume, pool, level, width, capacity=CACHE_SLICES):
+        self.volume = volume
+        self.pool = pool
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.pending = set()
+        self.luts = {}
+        self.level = level
+        self.width = width
+
+    def set_window(self, level, width):
+        with self.lock:
+            self.level = level
+            self.width = width
+            self.luts.clear()
+            self.cache.clear()
+
+    def clear(self):
+        with self.lock:
+            self.luts.clear()
+            self.cache.clear()
+
+    def memory(self):
+        with self.lock:
+            return sum(x.nbytes for x in self.cache.values())
+
+    def lut(self, n):
+        # One 16-bit -> 8-bit table per rescale, indexed by the raw stored bits of a pixel.
+        dtype = self.volume.pixels.dtype
+        key = (self.volume.slopes[n], self.volume.intercepts[n], self.level, self.width)
+        lut = self.luts.get(key)
+        if lut is None:
+            values = np.arange(2 ** (8 * dtype.itemsize), dtype=np.uint64).astype(f"u{dtype.itemsize}").view(dtype)
+            hu = values * key[0] + key[1]
+            lut = np.clip((hu - (self.level - self.width / 2)) / self.width * 255, 0, 255).astype(np.uint8)
+            self.luts[key] = lut
+        return lut
+
+    def is_loaded(self, n, axis=AXIAL):
+        return self.volume.loaded[n] if axis == AXIAL else self.volume.loaded.all()
+
+    def render(self, n, axis):
+        # Window lookup straight from the strided plane of the volume. Coronal and sagittal planes take every row
+        # from another slice, so rows of slices with a different rescale use their own table.
+        pixels = self.volume.section(axis, n)
+        raw = pixels.view(f"u{pixels.dtype.itemsize}")
+        with self.lock:
+            luts = [self.lut(n)] if axis == AXIAL else [self.lut(i) for i in range(len(self.volume) - 1, -1, -1)]
+        if all(lut is luts[0] for lut in luts):
+            return luts[0][raw]
+        img = np.empty(raw.shape, dtype=np.uint8)
+        for row, lut in enumerate(luts):
+            img[row] = lut[raw[row]]
+        return img
+
+    def slice(self, n, axis=AXIAL):
+        key = (axis, n)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            window = (self.level, self.width)
+
+        img = self.render(n, axis)
+        image = np.stack((img, img, img, np.full_like(img, 255)), 2)
+
+        # Planes with slices still being decoded are rendered but not kept.
+        if self.is_loaded(n, axis):
+            with self.lock:
+                if window == (self.level, self.width):
+                    self.cache[key] = image
+                    while len(self.cache) > self.capacity:
+                        self.cache.popitem(last=False)
+        return image
+
+    def prefetch(self, n, axis=AXIAL):
+        for i in range(1, PREFETCH_DISTANCE + 1):
+            for neighbor in (n + i, n - i):
+                if 0 <= neighbor < self.volume.shape[axis] and self.is_loaded(neighbor, axis):
+                    with self.lock:
+                        if (axis, neighbor) in self.cache or (axis, neighbor) in self.pending:
+                            continue
+                        self.pending.add((axis, neighbor))
+                    self.pool.start(RenderSlice(self, neighbor, axis))
@@ -0,0 +1,163 @@
+import numpy as np
+from pydicom import read_file
+from pydicom.errors import InvalidDicomError
+from Instrumentation import timed
+
+# Width of the DVH dose bins in Gy.
+BIN_WIDTH = 0.01
+# Metrics shown for every ROI: D95 is the dose received by at least 95% of the volume, V20 the percentage of the
+# volume receiving at least 20 Gy.
+DOSE_PERCENT = 95
+VOLUME_DOSE = 20
+
+
+def read_dose(path):
+    dataset = read_file(path)
+    if dataset.get("Modality") != "RTDOSE" or "PixelData" not in dataset:
+        raise InvalidDicomError(f"{path} is not an RT dose")
+    return DoseGrid(dataset)
+
+
+def axial_signs(orientations, what):
+    # Directions (+1 or -1) of patient x along the rows and of patient y along the columns of axial planes, from
+    # ImageOrientationPatient of one or more planes. Oblique and non-axial planes are not supported.
+    orientations = np.atleast_2d(np.asarray(orientations, dtype=np.float64))
+    aligned = np.abs(np.abs(orientations[:, [0, 4]]) - 1) < 1e-3
+    if not (aligned.all() and (np.abs(orientations[:, [1, 2, 3, 5]]) < 1e-3).all()):
+        raise ValueError(f"{what} is not axial: only ImageOrientationPatient of [±1, 0, 0, 0, ±1, 0] is supported")
+    return np.sign(orientations[:, [0, 4]])
+
+
+def interpolation_weights(positions, size):
+    # Lower and upper grid index, weight of the upper one and whether the position lies inside the grid, for
+    # fractional grid positions along one axis.
+    inside = (positions > -1e-6) & (positions < size - 1 + 1e-6)
+    lower = np.clip(np.floor(positions), 0, max(size - 2, 0)).astype(np.intp)
+    upper = np.minimum(lower + 1, size - 1)
+    weight = np.clip(positions - lower, 0, 1) if size > 1 else np.zeros_like(positions)
+    return lower, upper, weight, inside
+
+
+class DoseGrid:
+    def __init__(self, dataset):
+        self.file = dataset
+        self.values = dataset.pixel_array.reshape(-1, int(dataset.Rows), int(dataset.Columns)).astype(np.float32)
+        self.values *= float(dataset.get("DoseGridScaling", 1))
+
+        origin = np.array([float(v) for v in dataset.ImagePositionPatient])
+        self.signs = axial_signs([float(v) for v in dataset.ImageOrientationPatient], "The RT dose grid")[0]
+        offsets = np.array([float(v) for v in dataset.get("GridFrameOffsetVector", [0])])
+        # Offsets starting with 0 are relative to the first frame along the plane normal, others are absolute z.
+        self.z = origin[2] + offsets * self.signs[0] * self.signs[1] if offsets[0] == 0 else offsets
+        if len(self.z) > 1 and self.z[1] < self.z[0]:
+            self.z = self.z[::-1]
+            self.values = self.values[::-1]
+        self.origin = origin[:2]
+        self.spacing = np.array([float(v) for v in dataset.PixelSpacing])
+
+    def plane(self, z, rows, columns):
+        # Dose in Gy on the CT pixels at the given patient y (rows) and x (columns) positions of the plane z, by
+        # trilinear interpolation done one axis at a time. Pixels outside the grid get no dose.
+        if len(self.z) > 1:
+            position = np.interp(z, self.z, np.arange(len(self.z)), left=-1, right=len(self.z))
+        else:
+            position = 0.0 if abs(z - self.z[0]) < 1e-3 else -1.0
+        frame_lower, frame_upper, frame_weight, frame_inside = interpolation_weights(np.array([position]),
+                                                                                     len(self.z))
+        if not frame_inside[0]:
+            return np.zeros((len(rows), len(columns)), dtype=np.float32)
+
+        row_lower, row_upper, row_weight, row_inside = interpolation_weights(
+            (rows - self.origin[1]) / (self.spacing[0] * self.signs[1]), self.values.shape[1])
+        column_lower, column_upper, column_weight, column_inside = interpolation_weights(
+            (columns - self.origin[0]) / (self.spacing[1] * self.signs[0]), self.values.shape[2])
+
+        needed = np.unique(np.concatenate((row_lower, row_upper)))
+        frame = (self.values[frame_lower[0], needed] * (1 - frame_weight[0])
+                 + self.values[frame_upper[0], needed] * frame_weight[0])
+        row_lower, row_upper = np.searchsorted(needed, row_lower), np.searchsorted(needed, row_upper)
+        frame = frame[row_lower] * (1 - row_weight[:, None]) + frame[row_upper] * row_weight[:, None]
+        frame = frame[:, column_lower] * (1 - column_weight) + frame[:, column_upper] * column_weight
+        frame *= row_inside[:, None] & column_inside
+        return frame.astype(np.float32, copy=False)
+
+
+class DoseVolumeHistogram:
+    # Voxel counts per BIN_WIDTH dose bin plus the exact sum and extrema of the dose in an ROI.
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.total = 0
+        self.sum = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def add(self, doses):
+        if doses.size == 0:
+            return
+        bins = np.floor(doses / BIN_WIDTH).astype(np.int64)
+        counts = np.bincount(bins)
+        if counts.size > self.counts.size:
+            counts[:self.counts.size] += self.counts
+            self.counts = counts
+        else:
+            self.counts[:counts.size] += counts
+        self.total += doses.size
+        self.sum += float(doses.sum(dtype=np.float64))
+        self.minimum = min(self.minimum, float(doses.min()))
+        self.maximum = max(self.maximum, float(doses.max()))
+
+    def doses(self):
+        return np.arange(self.counts.size) * BIN_WIDTH
+
+    def differential(self):
+        # Fraction of the volume in every dose bin.
+        return self.counts / max(self.total, 1)
+
+    def cumulative(self):
+        # Fraction of the volume receiving at least the dose of every bin.
+        return np.cumsum(self.counts[::-1])[::-1] / max(self.total, 1)
+
+    def dose_at(self, percent):
+        # Highest bin dose still received by at least percent of the volume.
+        if self.total == 0:
+            return np.nan
+        covered = np.flatnonzero(self.cumulative() >= percent / 100)
+        return covered[-1] * BIN_WIDTH if covered.size else 0.0
+
+    def volume_at(self, dose):
+        if self.total == 0:
+            return np.nan
+        first = int(np.ceil(dose / BIN_WIDTH - 1e-9))
+        return 100 * self.counts[first:].sum() / self.total
+
+    def values(self):
+        if self.total == 0:
+            return {"dmin": np.nan, "dmean": np.nan, "dmax": np.nan, f"d{DOSE_PERCENT}": np.nan,
+                    f"v{VOLUME_DOSE}": np.nan}
+        return {"dmin": self.minimum, "dmean": self.sum / self.total, "dmax": self.maximum,
+                f"d{DOSE_PERCENT}": self.dose_at(DOSE_PERCENT), f"v{VOLUME_DOSE}": self.volume_at(VOLUME_DOSE)}
+
+
+@timed("dvh")
+def dose_volume_histograms(volume, masks, dose):
+    # DVH of every mask in masks (name -> SparseMask on the volume). One sweep over the slices: the dose is resampled
+    # once per slice on the bounding box of all ROIs on it and every ROI takes its voxels from that plane.
+    signs = axial_signs(volume.orientations, "The CT series")
+    histograms = {name: DoseVolumeHistogram() for name in masks}
+    for n in range(len(volume)):
+        regions = {name: mask.crop(n) for name, mask in masks.items()}
+        regions = {name: region for name, region in regions.items() if region is not None}
+        if not regions:
+            continue
+        top = min(x[0] for x in regions.values())
+        bottom = max(x[1] for x in regions.values())
+        left = min(x[2] for x in regions.values())
+        right = max(x[3] for x in regions.values())
+
+        # Axial slices: rows run along patient y and columns along patient x, in the direction of the orientation.
+        rows = volume.origins[n, 1] + np.arange(top, bottom) * volume.spacings[n, 0] * signs[n, 1]
+        columns = volume.origins[n, 0] + np.arange(left, right) * volume.spacings[n, 1] * signs[n, 0]
+        plane = dose.plane(volume.z[n], rows, columns)
+        for name, (mask_top, mask_bottom, mask_left, mask_right, mask) in regions.items():
+            histograms[name].add(plane[mask_top - top:mask_bottom - top, mask_left - left:mask_right - left][mask])
+    return histograms
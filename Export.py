@@ -0,0 +1,174 @@
+import csv
+import json
+import copy
+import os
+import numpy as np
+import cv2
+from PySide6.QtCore import QObject, QRunnable, Signal, Slot
+from Overlay import Overlay
+
+VIDEO_EXTENSIONS = (".avi", ".mp4")
+VIDEO_FPS = 10
+
+
+class ExportTask(QRunnable):
+    def __init__(self, exporter, function, args):
+        super().__init__()
+        self.exporter = exporter
+        self.function = function
+        self.args = args
+
+    def run(self):
+        if self.exporter.is_cancelled:
+            return
+        try:
+            self.function(self.exporter, *self.args)
+        except Exception as error:
+            self.exporter.step_failed.emit(str(error))
+
+
+class Exporter(QObject):
+    progress = Signal(int, int)
+    finished = Signal(str)
+    failed = Signal(str)
+    cancelled = Signal()
+
+    step_done = Signal()
+    step_failed = Signal(str)
+
+    def __init__(self, pool, path, tasks, total):
+        super().__init__()
+        self.pool = pool
+        self.path = path
+        self.tasks = tasks
+        self.total = total
+        self.done = 0
+        self.is_cancelled = False
+
+        self.step_done.connect(self.handle_done)
+        self.step_failed.connect(self.handle_failed)
+
+    def start(self):
+        for function, args in self.tasks:
+            self.pool.start(ExportTask(self, function, args))
+
+    def advance(self):
+        self.step_done.emit()
+
+    def cancel(self):
+        if self.is_cancelled:
+            return
+        self.is_cancelled = True
+        self.cancelled.emit()
+
+    @Slot()
+    def handle_done(self):
+        if self.is_cancelled:
+            return
+        self.done += 1
+        self.progress.emit(self.done, self.total)
+        if self.done == self.total:
+            self.finished.emit(self.path)
+
+    @Slot(str)
+    def handle_failed(self, message):
+        if self.is_cancelled:
+            return
+        self.is_cancelled = True
+        self.failed.emit(message)
+
+
+def snapshot(volume, names):
+    # The volume with copies of the named ROIs' masks and contour polygons, which the window may edit during the
+    # export; the pixels are shared.
+    frozen = copy.copy(volume)
+    frozen.masks = {name: type(volume.masks[name]).from_state(volume.shape, volume.masks[name].state())
+                    for name in names}
+    frozen.contours = {name: {n: list(polygons) for n, polygons in volume.contours.get(name, {}).items()}
+                       for name in names}
+    return frozen
+
+
+def render_slice(volume, display, layers, n):
+    return Overlay(volume).compose(n, display.slice(n), layers)
+
+
+def save_picture(exporter, path, volume, display, layers, n):
+    image = render_slice(volume, display, layers, n)
+    if not cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)):
+        raise OSError(f"Cannot write {path}")
+    exporter.advance()
+
+
+def save_video(exporter, path, volume, display, layers):
+    fourcc = cv2.VideoWriter_fourcc(*("mp4v" if path.lower().endswith(".mp4") else "MJPG"))
+    writer = cv2.VideoWriter(path, fourcc, VIDEO_FPS, (volume.shape[2], volume.shape[1]))
+    if not writer.isOpened():
+        raise OSError(f"Cannot write {path}")
+    try:
+        for n in range(len(volume)):
+            if exporter.is_cancelled:
+                return
+            writer.write(cv2.cvtColor(render_slice(volume, display, layers, n), cv2.COLOR_RGBA2BGR))
+            exporter.advance()
+    finally:
+        writer.release()
+
+
+def picture_tasks(path, volume, display, layers):
+    # A video is written frame by frame by one task, PNG files are rendered and encoded in parallel.
+    volume = snapshot(volume, [name for name, _ in layers])
+    if path.lower().endswith(VIDEO_EXTENSIONS):
+        return path, [(save_video, (path, volume, display, layers))], len(volume)
+    stem = os.path.splitext(path)[0]
+    tasks = [(save_picture, (f"{stem}_{n + 1:04d}.png", volume, display, layers, n)) for n in range(len(volume))]
+    return os.path.dirname(path), tasks, len(volume)
+
+
+def save_contours(exporter, path, volume, names):
+    # Masks are cropped to each ROI's bounding box and bit-packed along rows; polygons are stored as one point
+    # array per ROI with the slice and point count of every polygon.
+    arrays = {"names": np.array(names, dtype=str), "shape": np.array(volume.shape), "z": volume.z,
+              "origins": volume.origins, "spacings": volume.spacings}
+    for i, name in enumerate(names):
+        if exporter.is_cancelled:
+            return
+        box = volume.masks[name].box()
+        arrays[f"box_{i}"] = box
+        arrays[f"mask_{i}"] = np.packbits(volume.masks[name].dense(box), axis=-1)
+
+        polygons = [(n, contour.reshape(-1, 2)) for n, contours in sorted(volume.contours.get(name, {}).items())
+                    for contour in contours]
+        arrays[f"polygon_slices_{i}"] = np.array([n for n, _ in polygons], dtype=np.int32)
+        arrays[f"polygon_lengths_{i}"] = np.array([len(x) for _, x in polygons], dtype=np.int32)
+        arrays[f"polygon_points_{i}"] = (np.concatenate([x for _, x in polygons]).astype(np.float32) if polygons
+                                         else np.zeros((0, 2), dtype=np.float32))
+        exporter.advance()
+
+    np.savez_compressed(path, **arrays)
+    exporter.advance()
+
+
+def contour_tasks(path, volume, names):
+    if not path.lower().endswith(".npz"):
+        path += ".npz"
+    volume = snapshot(volume, names)
+    return path, [(save_contours, (path, volume, names))], len(names) + 1
+
+
+def save_data(exporter, path, rows):
+    if path.lower().endswith(".json"):
+        rows = [{key: None if isinstance(value, float) and np.isnan(value) else value for key, value in row.items()}
+                for row in rows]
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(rows, file, indent=2)
+    else:
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, list(rows[0]) if rows else [])
+            writer.writeheader()
+            writer.writerows(rows)
+    exporter.advance()
+
+
+def data_tasks(path, rows):
+    return path, [(save_data, (path, rows))], 1
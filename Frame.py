@@ -0,0 +1,34 @@
+from pydicom import read_file
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+
+# Elements larger than this (pixel data in practice) are only read from disk when they are accessed.
+DEFER_SIZE = "64 KB"
+
+
+def read_header(path, rt_struct=False):
+    if rt_struct:
+        dataset = read_file(path)
+        required = "StructureSetROISequence"
+    else:
+        dataset = read_file(path, defer_size=DEFER_SIZE)
+        required = "PixelData"
+    if required not in dataset:
+        raise InvalidDicomError(f"{path} has no {required}")
+    return dataset
+
+
+class Frame:
+    # An RT structure set; the CT series itself lives in Volume.
+    def __init__(self, x):
+
+        self.file = x if isinstance(x, Dataset) else read_file(x)
+        self.sup_uid = self.file.SOPInstanceUID
+
+        self.num_contours = len(self.file.StructureSetROISequence)
+        self.contours_names = [self.file.StructureSetROISequence[i].ROIName for i in range(self.num_contours)]
+        self.contours_sequences = [self.file.ROIContourSequence[i].get("ContourSequence", [])
+                                   for i in range(self.num_contours)]
+        self.contours_properties = {}
+        self.dose = None
+        self.contours_dvhs = {}
@@ -0,0 +1,114 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Set to a file path to append one JSON line per measured call.
+LOG_VARIABLE = "MAKSCONTOURS_PROFILE_LOG"
+
+
+def peak_memory():
+    # Peak resident set size of the process in bytes, None where it cannot be read cheaply.
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, "peak_wset", info.rss)
+
+
+class Stage:
+    __slots__ = ("calls", "total", "last", "longest", "memory_growth")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.longest = 0.0
+        self.memory_growth = 0
+
+
+class Profiler:
+    def __init__(self, log_path=None):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.log_path = log_path if log_path is not None else os.environ.get(LOG_VARIABLE)
+
+    @contextmanager
+    def measure(self, name):
+        memory = peak_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            growth = peak_memory() - memory if memory is not None else 0
+            self.record(name, duration, growth)
+
+    def record(self, name, duration, memory_growth=0):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage()
+            stage.calls += 1
+            stage.total += duration
+            stage.last = duration
+            stage.longest = max(stage.longest, duration)
+            stage.memory_growth += memory_growth
+        if self.log_path:
+            self.write_log({"time": time.time(), "stage": name, "duration": duration,
+                            "peak_memory_growth": memory_growth, "peak_memory": peak_memory()})
+
+    def write_log(self, entry):
+        with self.lock, open(self.log_path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(entry) + "\n")
+
+    def snapshot(self):
+        with self.lock:
+            return {name: {"calls": x.calls, "total": x.total, "last": x.last, "longest": x.longest,
+                           "peak_memory_growth": x.memory_growth} for name, x in self.stages.items()}
+
+    def status(self, names):
+        stages = self.snapshot()
+        return " | ".join(f"{name} {format_duration(stages[name]['last'])}" for name in names if name in stages)
+
+    def summary(self):
+        lines = [f"{'Stage':<20}{'Calls':>8}{'Total':>12}{'Mean':>12}{'Longest':>12}{'Peak +MB':>10}"]
+        for name, x in sorted(self.snapshot().items(), key=lambda item: -item[1]["total"]):
+            lines.append(f"{name:<20}{x['calls']:>8}{format_duration(x['total']):>12}"
+                         f"{format_duration(x['total'] / x['calls']):>12}{format_duration(x['longest']):>12}"
+                         f"{x['peak_memory_growth'] / 1024 ** 2:>10.1f}")
+        memory = peak_memory()
+        if memory is not None:
+            lines.append(f"Process peak memory: {memory / 1024 ** 2:.0f} MB")
+        return "\n".join(lines)
+
+
+def format_duration(seconds):
+    if seconds < 1:
+        return f"{seconds * 1000:.1f} ms"
+    return f"{seconds:.2f} s"
+
+
+PROFILER = Profiler()
+
+
+def timed(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with PROFILER.measure(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,232 @@
+from PySide6.QtCore import QObject, QRunnable, Signal, Slot
+from Frame import read_header
+from Volume import Volume
+from Dose import read_dose, dose_volume_histograms
+from StudyIndex import StudyIndex
+from Instrumentation import PROFILER
+
+
+class LoadSlice(QRunnable):
+    def __init__(self, loader, n):
+        super().__init__()
+        self.loader = loader
+        self.n = n
+
+    def run(self):
+        if self.loader.is_cancelled:
+            return
+        try:
+            with PROFILER.measure("decode_slice"):
+                self.loader.volume.read_slice(self.n)
+        except Exception as error:
+            self.loader.slice_failed.emit(f"Invalid file: {self.loader.volume.datasets[self.n].filename}\n{error}")
+            return
+        self.loader.slice_decoded.emit(self.n)
+
+
+class ReadHeader(QRunnable):
+    def __init__(self, reader, path):
+        super().__init__()
+        self.reader = reader
+        self.path = path
+
+    def run(self):
+        if self.reader.is_cancelled:
+            return
+        try:
+            dataset = read_header(self.path, self.reader.rt_struct)
+        except Exception:
+            # Any parse error counts as an invalid file, so the reader still finishes.
+            self.reader.header_failed.emit(self.path)
+            return
+        self.reader.header_read.emit(self.path, dataset)
+
+
+class SeriesLoader(QObject):
+    # The signals after the blank line are emitted from the pool's threads and handled in the thread owning the loader,
+    # which emits the ones above. HeaderReader, StudyScanner, DoseLoader and Export.Exporter work the same way.
+    slice_loaded = Signal(int)
+    progress = Signal(int, int)
+    finished = Signal(object)
+    failed = Signal(str)
+    cancelled = Signal()
+
+    slice_decoded = Signal(int)
+    slice_failed = Signal(str)
+
+    def __init__(self, pool, datasets, backing=None):
+        super().__init__()
+        self.pool = pool
+        self.volume = Volume(datasets, backing)
+        self.done = 0
+        self.is_cancelled = False
+
+        self.slice_decoded.connect(self.handle_decoded)
+        self.slice_failed.connect(self.handle_failed)
+
+    def start(self):
+        for n in range(len(self.volume)):
+            self.pool.start(LoadSlice(self, n))
+
+    def cancel(self):
+        if self.is_cancelled:
+            return
+        # Queued tasks see the flag and return without reading their file.
+        self.is_cancelled = True
+        self.cancelled.emit()
+
+    @Slot(int)
+    def handle_decoded(self, n):
+        if self.is_cancelled:
+            return
+        self.done += 1
+        self.slice_loaded.emit(n)
+        self.progress.emit(self.done, len(self.volume))
+        if self.done == len(self.volume):
+            self.finished.emit(self.volume)
+
+    @Slot(str)
+    def handle_failed(self, message):
+        if self.is_cancelled:
+            return
+        self.is_cancelled = True
+        self.failed.emit(message)
+
+
+class HeaderReader(QObject):
+    finished = Signal(list)
+    failed = Signal(str)
+
+    header_read = Signal(str, object)
+    header_failed = Signal(str)
+
+    def __init__(self, pool, paths, cache, rt_struct=False):
+        super().__init__()
+        self.pool = pool
+        self.paths = list(paths)
+        self.cache = cache
+        self.rt_struct = rt_struct
+        self.remaining = 0
+        self.is_cancelled = False
+
+        self.header_read.connect(self.handle_read)
+        self.header_failed.connect(self.handle_failed)
+
+    def start(self):
+        missing = [path for path in self.paths if path not in self.cache]
+        self.remaining = len(missing)
+        if self.remaining == 0:
+            self.finished.emit([self.cache[path] for path in self.paths])
+        for path in missing:
+            self.pool.start(ReadHeader(self, path))
+
+    @Slot(str, object)
+    def handle_read(self, path, dataset):
+        if self.is_cancelled:
+            return
+        self.cache[path] = dataset
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.finished.emit([self.cache[path] for path in self.paths])
+
+    @Slot(str)
+    def handle_failed(self, path):
+        if self.is_cancelled:
+            return
+        self.is_cancelled = True
+        self.failed.emit(path)
+
+
+class ScanStudies(QRunnable):
+    def __init__(self, scanner):
+        super().__init__()
+        self.scanner = scanner
+
+    def run(self):
+        # SQLite connections belong to the thread that opened them, so the index is opened here.
+        try:
+            index = StudyIndex(self.scanner.index_path)
+            try:
+                index.scan(self.scanner.root, self.scanner.progress.emit, lambda: self.scanner.is_cancelled)
+                series = index.series(self.scanner.root)
+            finally:
+                index.close()
+        except Exception as error:
+            self.scanner.scan_failed.emit(str(error))
+            return
+        self.scanner.scan_done.emit(series)
+
+
+class StudyScanner(QObject):
+    progress = Signal(int, int)
+    finished = Signal(list)
+    failed = Signal(str)
+
+    scan_done = Signal(list)
+    scan_failed = Signal(str)
+
+    def __init__(self, pool, root, index_path=None):
+        super().__init__()
+        self.pool = pool
+        self.root = root
+        self.index_path = index_path
+        self.is_cancelled = False
+
+        self.scan_done.connect(self.handle_done)
+        self.scan_failed.connect(self.handle_failed)
+
+    def start(self):
+        self.pool.start(ScanStudies(self))
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    @Slot(list)
+    def handle_done(self, series):
+        if not self.is_cancelled:
+            self.finished.emit(series)
+
+    @Slot(str)
+    def handle_failed(self, message):
+        if not self.is_cancelled:
+            self.failed.emit(message)
+
+
+class ComputeDose(QRunnable):
+    def __init__(self, loader):
+        super().__init__()
+        self.loader = loader
+
+    def run(self):
+        try:
+            dose = read_dose(self.loader.path)
+            histograms = dose_volume_histograms(self.loader.volume, self.loader.masks, dose)
+        except Exception as error:
+            self.loader.dose_failed.emit(f"Cannot use the RT dose {self.loader.path}\n{error}")
+            return
+        self.loader.dose_done.emit(dose, histograms)
+
+
+class DoseLoader(QObject):
+    finished = Signal(object, dict)
+    failed = Signal(str)
+
+    dose_done = Signal(object, dict)
+    dose_failed = Signal(str)
+
+    def __init__(self, pool, path, volume, names):
+        super().__init__()
+        self.pool = pool
+        self.path = path
+        self.volume = volume
+        # Copies of the masks, so ROIs edited on the GUI thread meanwhile are not read half-changed by the worker.
+        self.masks = {}
+        for name in names:
+            mask = volume.masks[name]
+            self.masks[name] = type(mask).from_state(mask.shape, mask.state())
+
+        self.dose_done.connect(self.finished)
+        self.dose_failed.connect(self.failed)
+
+    def start(self):
+        self.pool.start(ComputeDose(self))
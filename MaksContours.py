@@ -1,11 +1,35 @@
-from PySide6.QtCore import QThreadPool
-from PySide6.QtGui import QImage, QPixmap
-from PySide6.QtWidgets import QApplication, QGridLayout, QTableWidget, QSlider
+import importlib
+import os
+import threading
+import time
+from PySide6.QtCore import Qt, QDir, QEvent, QThreadPool, QTimer, Slot
+from PySide6.QtWidgets import QApplication, QWidget, QGridLayout, QTableWidget, QTableWidgetItem, QSlider, \
+    QProgressBar, QComboBox, QFileDialog, QInputDialog, QLabel, QPushButton, QMessageBox, QTabWidget, QVBoxLayout
 from ColorButton import ColorButton
-from SelectFiles import *
-from SelectFolder import *
-from Masks import *
-import cv2
+from Instrumentation import PROFILER, timed
+from Settings import WINDOW_PRESETS, memory_budget
+from Session import Session, Study
+from SelectFiles import SelectFiles, SelectContour
+from SelectFolder import SelectFolder
+from SectionView import PLANES, SectionView, scaled_pixmap
+
+STATUS_STAGES = ("read_data", "generate_rows", "change_img", "change_section", "update_contours", "edit_slice")
+DOSE_COLUMNS = ("Dmean (Gy)", "Dmax (Gy)", "D95 (Gy)", "V20 (%)")
+DRAWING_COLOR = (255, 255, 0, 255)
+
+# numpy, OpenCV and pydicom are only needed once a study is opened. They are imported where they are used, and
+# preloaded in the background while the folder browser is shown.
+HEAVY_MODULES = ("numpy", "cv2", "pydicom", "Frame", "Volume", "Loader", "Masks", "Cache", "Display", "Overlay",
+                 "Export", "RoiAlgebra", "Dose")
+
+
+def preload():
+    def run():
+        with PROFILER.measure("preload"):
+            for module in HEAVY_MODULES:
+                importlib.import_module(module)
+
+    threading.Thread(target=run, name="preload", daemon=True).start()
 
 
 class MainWindow(QWidget):
@@ -17,12 +41,14 @@ class MainWindow(QWidget):
         self.colors_used = set()
 
         self.workers = QThreadPool()
+        self.mask_cache = None
 
-        self.folder_selector = SelectFolder()
-        self.file_selector = SelectFiles()
-        self.contour_selector = SelectContour()
+        self.folder_selector = SelectFolder(self.workers)
+        self.file_selector = SelectFiles(self.workers)
+        self.contour_selector = SelectContour(self.workers)
 
         self.folder_selector.success.connect(self.folder_selected)
+        self.folder_selector.study_selected.connect(self.study_selected)
         self.file_selector.success.connect(self.files_selected)
         self.contour_selector.success.connect(self.contours_selected)
 
@@ -37,6 +63,8 @@ class MainWindow(QWidget):
         self.selected_folder = None
         self.selected_files = None
         self.selected_contours = None
+        self.selected_datasets = None
+        self.selected_contour_dataset = None
 
         self.setWindowTitle("MaksContours")
         self.layout = QGridLayout()
@@ -47,56 +75,469 @@ class MainWindow(QWidget):
         self.preview.setAlignment(Qt.AlignCenter)
 
         self.table = QTableWidget()
-        self.table.setColumnCount(9)
+        self.table.setColumnCount(9 + len(DOSE_COLUMNS))
         self.table.setHorizontalHeaderLabels(
-            ["ID", "Name", "Color", "Min (HU)", "Max (HU)", "Mean (HU)", "Std HU()", "Median (HU)", "Volume (voxels)"])
+            ["ID", "Name", "Color", "Min (HU)", "Max (HU)", "Mean (HU)", "Std HU()", "Median (HU)", "Volume (voxels)",
+             *DOSE_COLUMNS])
 
         self.exp_pics_button = QPushButton("Save pictures")
         self.exp_contours_button = QPushButton("Save contours")
         self.exp_data_button = QPushButton("Save data")
         self.add_contour_button = QPushButton("Add contour")
         self.add_area_button = QPushButton("Add area")
+        self.derive_button = QPushButton("Derive structure")
+        self.dose_button = QPushButton("Load dose")
+        self.exp_pics_button.clicked.connect(self.export_pictures)
+        self.exp_contours_button.clicked.connect(self.export_contours)
+        self.exp_data_button.clicked.connect(self.export_data)
+        self.add_contour_button.clicked.connect(self.add_contour)
+        self.add_area_button.clicked.connect(self.add_area)
+        self.derive_button.clicked.connect(self.derive_structure)
+        self.dose_button.clicked.connect(self.load_dose)
 
         self.preview_slider = QSlider(Qt.Horizontal)
         self.value = 0
         self.preview_slider.setMinimum(0)
         self.preview_slider.setValue(self.value)
         self.preview_slider.valueChanged.connect(self.change_img)
-
-        self.layout.addWidget(self.preview, 0, 0, 4, 3)
-        self.layout.addWidget(self.preview_slider, 4, 0, 1, 3)
-        self.layout.addWidget(self.add_contour_button, 0, 3, 1, 3)
-        self.layout.addWidget(self.add_area_button, 1, 3, 1, 3)
+        self.table.cellChanged.connect(self.handle_item_checked)
+
+        # Axial slices on the first tab, coronal and sagittal planes resliced from the same volume on the others.
+        self.axial_view = QWidget()
+        axial_layout = QVBoxLayout()
+        axial_layout.setContentsMargins(0, 0, 0, 0)
+        axial_layout.addWidget(self.preview)
+        axial_layout.addWidget(self.preview_slider)
+        self.axial_view.setLayout(axial_layout)
+        self.views = QTabWidget()
+        self.views.addTab(self.axial_view, "Axial")
+        self.sections = []
+        for name, axis in PLANES:
+            view = SectionView(axis)
+            view.changed.connect(self.update_section)
+            self.views.addTab(view, name)
+            self.sections.append(view)
+        self.views.currentChanged.connect(lambda _: self.update_section())
+
+        self.window_selector = QComboBox()
+        self.window_selector.addItems(list(WINDOW_PRESETS))
+        self.window_selector.currentTextChanged.connect(self.change_window)
+
+        self.progress_bar = QProgressBar()
+        self.status = QLabel()
+        self.diagnostics_button = QPushButton("Diagnostics")
+        self.diagnostics_button.clicked.connect(self.show_diagnostics)
+
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_task)
+
+        self.session = Session(memory_budget())
+        self.study = None
+        self.study_selector = QComboBox()
+        self.study_selector.currentIndexChanged.connect(self.switch_study)
+        self.open_button = QPushButton("Open study")
+        self.open_button.clicked.connect(self.open_study)
+        self.close_button = QPushButton("Close study")
+        self.close_button.clicked.connect(self.close_study)
+
+        self.layout.addWidget(self.views, 0, 0, 5, 3)
+        self.layout.addWidget(self.add_contour_button, 0, 3, 1, 2)
+        self.layout.addWidget(self.dose_button, 0, 5)
+        self.layout.addWidget(self.add_area_button, 1, 3, 1, 2)
+        self.layout.addWidget(self.derive_button, 1, 5)
         self.layout.addWidget(self.table, 2, 3, 2, 3)
         self.layout.addWidget(self.exp_pics_button, 4, 3)
         self.layout.addWidget(self.exp_contours_button, 4, 4)
         self.layout.addWidget(self.exp_data_button, 4, 5)
+        self.layout.addWidget(self.window_selector, 5, 0, 1, 3)
+        self.layout.addWidget(self.study_selector, 5, 3)
+        self.layout.addWidget(self.close_button, 5, 4)
+        self.layout.addWidget(self.open_button, 5, 5)
+        self.layout.addWidget(self.progress_bar, 6, 0, 1, 3)
+        self.layout.addWidget(self.cancel_button, 6, 3, 1, 3)
+        self.layout.addWidget(self.status, 7, 0, 1, 5)
+        self.layout.addWidget(self.diagnostics_button, 7, 5)
         self.setLayout(self.layout)
 
-        self.frames = None
+        self.volume = None
         self.contour_frame = None
         self.image = None
+        self.overlay = None
+        self.display = None
+        self.loader = None
+        self.files_reader = None
+        self.contour_reader = None
+        self.exporter = None
+        self.dose_loader = None
+        self.dose_edits = set()
+        self.load_start = None
+        self.drawing = None
+        self.points = []
+        self.preview.installEventFilter(self)
 
     def read_data(self):
-        self.frames = [Frame(x) for x in self.selected_files]
-        self.frames.sort(key=lambda x: x.z)
-        self.contour_frame = Frame(self.selected_contours, True)
+        from Loader import SeriesLoader
+
+        key = f"{self.selected_contours}|{self.selected_datasets[0].get('SeriesInstanceUID', '')}"
+        if key in self.session:
+            self.study_selector.setCurrentIndex(self.study_selector.findData(key))
+            self.show()
+            return
+
+        if self.loader is not None:
+            # The series still loading is given up for the new one; its queued signals must not reach the window.
+            self.loader.blockSignals(True)
+            self.loader.cancel()
+            self.loader = None
+
+        self.store_rows()
+        self.study = None
+        self.drawing = None
+        self.table.setRowCount(0)
+        self.ids_used = set()
+        self.study_selector.setEnabled(False)
+        self.open_button.setEnabled(False)
+
+        self.load_start = time.perf_counter()
+        self.volume = None
+        self.overlay = None
+        self.display = None
+        self.value = 0
+        self.progress_bar.setMaximum(len(self.selected_datasets))
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.cancel_button.show()
+
+        try:
+            self.loader = SeriesLoader(self.workers, self.selected_datasets)
+        except (AttributeError, ValueError) as error:
+            self.loading_failed(f"Invalid CT series: {error}")
+            return
+        self.loader.slice_loaded.connect(self.slice_loaded)
+        self.loader.progress.connect(self.progress_bar.setValue)
+        self.loader.finished.connect(self.series_loaded)
+        self.loader.failed.connect(self.loading_failed)
+        self.loader.cancelled.connect(self.loading_cancelled)
+        self.loader.start()
+
+    @Slot()
+    def slice_loaded(self, n):
+        from Display import Display
+
+        if self.volume is None:
+            self.volume = self.loader.volume
+            self.display = Display(self.volume, self.workers, *WINDOW_PRESETS[self.window_selector.currentText()])
+            self.preview_slider.blockSignals(True)
+            self.preview_slider.setMaximum(len(self.volume) - 1)
+            self.preview_slider.setValue(n)
+            self.preview_slider.blockSignals(False)
+            self.reset_sections()
+            self.change_img(n)
+            self.show()
+        elif n == self.value:
+            self.change_img(n)
+
+    @Slot()
+    def series_loaded(self, volume):
+        from Frame import Frame
+
+        PROFILER.record("read_data", time.perf_counter() - self.load_start)
+        self.loader = None
+        self.volume = volume
+        self.contour_frame = Frame(self.selected_contour_dataset)
+        self.generate_rows()
+
+        key = f"{self.selected_contours}|{volume.datasets[0].get('SeriesInstanceUID', '')}"
+        name = f"{self.contour_frame.file.get('PatientName', '')} ({os.path.basename(self.selected_contours)})"
+        self.study = self.session.add(Study(key, name, volume, self.contour_frame, self.display, self.overlay))
+        self.study_selector.blockSignals(True)
+        self.study_selector.addItem(name, key)
+        self.study_selector.setCurrentIndex(self.study_selector.count() - 1)
+        self.study_selector.blockSignals(False)
+        self.study_selector.setEnabled(True)
+        self.open_button.setEnabled(True)
+
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        self.change_img(self.value)
+
+    @Slot()
+    def cancel_task(self):
+        if self.loader is not None:
+            self.loader.cancel()
+        if self.exporter is not None:
+            self.exporter.cancel()
+
+    @Slot()
+    def loading_failed(self, text):
+        message = QMessageBox()
+        message.setText("Error!")
+        message.setInformativeText(text)
+        message.exec()
+        self.loading_cancelled()
+
+    @Slot()
+    def loading_cancelled(self):
+        self.loader = None
+        self.volume = None
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        self.study_selector.setEnabled(True)
+        self.open_button.setEnabled(True)
+        if len(self.session):
+            self.show_study(self.study_selector.currentData())
+        else:
+            self.hide()
+            self.contour_selector.show()
+
+    @Slot()
+    def open_study(self):
+        self.folder_selector.show()
+        self.folder_selector.raise_()
+
+    @Slot()
+    def close_study(self):
+        # Exports read the shown study from worker threads, and a series being loaded has no study yet.
+        if self.study is None or self.exporter is not None or self.loader is not None:
+            return
+        self.session.close(self.study.key)
+        self.study_selector.blockSignals(True)
+        self.study_selector.removeItem(self.study_selector.findData(self.study.key))
+        self.study_selector.blockSignals(False)
+        self.study = None
+        self.drawing = None
+        if len(self.session):
+            self.show_study(self.study_selector.currentData())
+        else:
+            self.volume = None
+            self.contour_frame = None
+            self.display = None
+            self.overlay = None
+            self.image = None
+            self.table.setRowCount(0)
+            self.hide()
+            self.contour_selector.show()
+
+    @Slot()
+    def switch_study(self, index):
+        key = self.study_selector.itemData(index)
+        if key is not None and (self.study is None or key != self.study.key):
+            self.store_rows()
+            self.show_study(key)
+
+    def show_study(self, key):
+        # Studies that were released are brought back into RAM by the session before they are shown.
+        from Overlay import Overlay
+
+        study = self.session.activate(key)
+        self.study = study
+        self.volume = study.volume
+        self.contour_frame = study.contour_frame
+        self.display = study.display
+        if study.overlay is None:
+            study.overlay = Overlay(study.volume)
+        self.overlay = study.overlay
+        self.drawing = None
+
+        level, width = WINDOW_PRESETS[self.window_selector.currentText()]
+        if (self.display.level, self.display.width) != (level, width):
+            self.display.set_window(level, width)
+
+        self.table.blockSignals(True)
+        self.table.setRowCount(0)
+        for row, (name, (code, color, checked)) in enumerate(zip(self.contour_frame.contours_names, study.rows)):
+            self.add_row(row, name)
+            self.table.item(row, 0).setText(code)
+            self.table.item(row, 0).setCheckState(Qt.Checked if checked else Qt.Unchecked)
+            self.table.cellWidget(row, 2).set_color(color)
+            self.add_properties(row, self.contour_frame.contours_properties[name])
+        self.ids_used = {code for code, _, _ in study.rows}
+        self.table.blockSignals(False)
+
+        self.preview_slider.blockSignals(True)
+        self.preview_slider.setMaximum(len(self.volume) - 1)
+        self.preview_slider.setValue(study.value)
+        self.preview_slider.blockSignals(False)
+        self.value = study.value
+        self.reset_sections()
+        self.change_img(study.value)
+
+    def store_rows(self):
+        if self.study is None:
+            return
+        self.study.rows = [(self.table.item(row, 0).text(), self.table.cellWidget(row, 2).color,
+                            self.table.item(row, 0).checkState() == Qt.Checked) for row in range(self.table.rowCount())]
+        self.study.value = self.value
 
     @Slot()
     def change_img(self, value):
-        self.value = value
-        img = self.frames[self.value].raw_img
-        img = (img / np.amax(img) * 255).astype(np.uint8)
-        self.image = np.stack((img, img, img, np.ones_like(img) * 255), 2)
-        self.update_contours()
+        with PROFILER.measure("change_img"):
+            if value != self.value:
+                self.points = []
+            self.value = value
+            self.image = self.display.slice(self.value)
+            self.update_contours()
+            self.show_image()
+            self.display.prefetch(self.value)
+        self.update_status()
+        self.update_section()
+
+    def reset_sections(self):
+        from Overlay import Overlay
+
+        for view in self.sections:
+            view.reset(self.volume.shape[view.axis], Overlay(self.volume, axis=view.axis))
+
+    @Slot()
+    def update_section(self):
+        # Only the plane on the visible tab is rendered; its strided view is windowed and composited like a slice.
+        view = self.views.currentWidget()
+        if view not in self.sections or self.display is None or view.overlay is None:
+            return
+        with PROFILER.measure("change_section"):
+            image = view.overlay.compose(view.value, self.display.slice(view.value, view.axis), self.visible_layers())
+            view.show_image(image, self.volume.aspect(view.axis))
+            self.display.prefetch(view.value, view.axis)
+        self.update_status()
+
+    @Slot()
+    def change_window(self, preset):
+        if self.display is not None:
+            self.display.set_window(*WINDOW_PRESETS[preset])
+            self.change_img(self.value)
+
+    @Slot()
+    def load_dose(self):
+        # The dose grid is read and the DVHs of all ROIs computed in the background.
+        from Loader import DoseLoader
+
+        if self.overlay is None or self.dose_loader is not None:
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Load dose", self.selected_folder or "",
+                                              "DICOM (*.dcm);;All files (*)")
+        if not path:
+            return
+        self.dose_button.setEnabled(False)
+        self.dose_edits = set()
+        self.dose_loader = DoseLoader(self.workers, path, self.volume, self.contour_frame.contours_names)
+        self.dose_loader.finished.connect(lambda dose, histograms, study=self.study:
+                                          self.dose_loaded(study, dose, histograms))
+        self.dose_loader.failed.connect(self.dose_failed)
+        self.dose_loader.start()
+
+    def dose_loaded(self, study, dose, histograms):
+        self.dose_loader = None
+        self.dose_button.setEnabled(True)
+        study.contour_frame.dose = dose
+        study.contour_frame.contours_dvhs = histograms
+        # ROIs added or edited while the dose was being processed.
+        for name in study.contour_frame.contours_names:
+            if name not in histograms or name in self.dose_edits:
+                self.update_dose(name, study.contour_frame, study.volume)
+        self.dose_edits = set()
+        if study is self.study:
+            self.table.blockSignals(True)
+            for row, name in enumerate(self.contour_frame.contours_names):
+                self.add_dose(row, name)
+            self.table.blockSignals(False)
+
+    @Slot()
+    def dose_failed(self, text):
+        self.dose_loader = None
+        self.dose_button.setEnabled(True)
+        message = QMessageBox()
+        message.setText("Error!")
+        message.setInformativeText(text)
+        message.exec()
+
+    def update_dose(self, name, contour_frame=None, volume=None):
+        from Dose import dose_volume_histograms
+
+        contour_frame = contour_frame or self.contour_frame
+        volume = volume or self.volume
+        if self.dose_loader is not None and self.dose_loader.volume is volume:
+            # The loader works on copies of the masks from before this change.
+            self.dose_edits.add(name)
+        elif contour_frame.dose is not None:
+            histograms = dose_volume_histograms(volume, {name: volume.masks[name]}, contour_frame.dose)
+            contour_frame.contours_dvhs[name] = histograms[name]
+
+    @Slot()
+    def export_pictures(self):
+        from Export import picture_tasks
+
+        if self.overlay is None or self.exporter is not None:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Save pictures", "", "PNG images (*.png);;Video (*.avi *.mp4)")
+        if path:
+            self.start_export(*picture_tasks(path, self.volume, self.display, self.visible_layers()))
+
+    @Slot()
+    def export_contours(self):
+        from Export import contour_tasks
+
+        if self.overlay is None or self.exporter is not None:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Save contours", "", "NumPy archive (*.npz)")
+        if path:
+            self.start_export(*contour_tasks(path, self.volume, self.contour_frame.contours_names))
+
+    @Slot()
+    def export_data(self):
+        from Export import data_tasks
+
+        if self.overlay is None or self.exporter is not None:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Save data", "", "CSV (*.csv);;JSON (*.json)")
+        if path:
+            rows = []
+            for row, name in enumerate(self.contour_frame.contours_names):
+                values = self.contour_frame.contours_properties[name].values()
+                if self.contour_frame.dose is not None:
+                    values.update(self.contour_frame.contours_dvhs[name].values())
+                rows.append({"id": self.table.item(row, 0).text(), "name": name, **values})
+            self.start_export(*data_tasks(path, rows))
+
+    def start_export(self, path, tasks, total):
+        from Export import Exporter
+
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.cancel_button.show()
+
+        self.exporter = Exporter(self.workers, path, tasks, total)
+        self.exporter.progress.connect(self.progress_bar.setValue)
+        self.exporter.finished.connect(self.export_finished)
+        self.exporter.failed.connect(self.export_failed)
+        self.exporter.cancelled.connect(self.export_finished)
+        self.exporter.start()
+
+    @Slot()
+    def export_finished(self):
+        self.exporter = None
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+
+    @Slot()
+    def export_failed(self, text):
+        self.export_finished()
+        message = QMessageBox()
+        message.setText("Error!")
+        message.setInformativeText(text)
+        message.exec()
+
+    def show_image(self):
+        import numpy as np
+        import cv2
+        from Volume import AXIAL
+
         # img = np.array(self.image[150:-150, 150:-150, :])
         img = np.array(self.image)
+        if self.drawing is not None and self.points:
+            cv2.polylines(img, [np.round(self.points).astype(np.int32).reshape(-1, 1, 2)], False, DRAWING_COLOR)
 
-        pixmap = QPixmap.fromImage(QImage(img.data,
-                                          img.shape[1], img.shape[0], img.shape[1] * 4,
-                                          QImage.Format_RGBA8888))
-        pixmap = pixmap.scaled(self.preview.size(), Qt.KeepAspectRatio)
-        self.preview.setPixmap(pixmap)
+        self.preview.setPixmap(scaled_pixmap(img, self.preview.size(), self.volume.aspect(AXIAL)))
 
     @Slot()
     def folder_selected(self):
@@ -108,25 +549,62 @@ class MainWindow(QWidget):
         self.folder_selector.hide()
         self.file_selector.show()
 
+    @Slot()
+    def study_selected(self, paths, structure_path):
+        # Opening a study found by the index: the same header validation as the file lists, without the lists.
+        from Loader import HeaderReader
+
+        self.selected_folder = os.path.dirname(paths[0])
+        for selector in (self.file_selector, self.contour_selector):
+            selector.selected_directory = QDir(self.selected_folder)
+            selector.populate_list()
+        self.selected_files = paths
+        self.selected_contours = structure_path
+        self.folder_selector.setEnabled(False)
+
+        self.files_reader = HeaderReader(self.workers, paths, self.file_selector.datasets)
+        self.contour_reader = HeaderReader(self.workers, [structure_path], self.contour_selector.datasets, True)
+        self.files_reader.finished.connect(self.study_files_read)
+        self.contour_reader.finished.connect(self.study_contour_read)
+        for reader in (self.files_reader, self.contour_reader):
+            reader.failed.connect(self.study_failed)
+        self.files_reader.start()
+
+    @Slot()
+    def study_files_read(self, datasets):
+        self.selected_datasets = datasets
+        self.contour_reader.start()
+
+    @Slot()
+    def study_contour_read(self, datasets):
+        self.selected_contour_dataset = datasets[0]
+        self.folder_selector.setEnabled(True)
+        self.folder_selector.hide()
+
+        self.read_data()
+
+    @Slot()
+    def study_failed(self, path):
+        self.folder_selector.setEnabled(True)
+        message = QMessageBox()
+        message.setText("Error!")
+        message.setInformativeText(f"Invalid file: {path}")
+        message.exec()
+
     @Slot()
     def files_selected(self):
         self.selected_files = self.file_selector.selected_files
+        self.selected_datasets = self.file_selector.selected_datasets
         self.file_selector.hide()
         self.contour_selector.show()
 
     @Slot()
     def contours_selected(self):
         self.selected_contours = self.contour_selector.selected_files
+        self.selected_contour_dataset = self.contour_selector.selected_datasets
         self.contour_selector.hide()
 
         self.read_data()
-        self.generate_rows()
-
-        self.preview_slider.setMaximum(len(self.frames) - 1)
-        self.preview_slider.setValue(0)
-        self.change_img(0)
-
-        self.show()
 
     @Slot()
     def files_back(self):
@@ -140,47 +618,220 @@ class MainWindow(QWidget):
         self.contour_selector.hide()
         self.file_selector.show()
 
+    @timed("generate_rows")
     def generate_rows(self):
+        from Cache import MaskCache
+        from Masks import build_rois
+        from Overlay import Overlay
+
+        if self.mask_cache is None:
+            self.mask_cache = MaskCache()
         names = self.contour_frame.contours_names
+        self.table.blockSignals(True)
         for row, name in enumerate(names):
-            self.table.insertRow(row)
-
-            id_item = QTableWidgetItem()
-            id_item.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-            id_item.setText(self.get_id())
-            id_item.setCheckState(Qt.Unchecked)
-            self.table.setItem(row, 0, id_item)
-            self.table.cellChanged.connect(self.handle_item_checked)
-
-            name_item = QTableWidgetItem(name)
-            name_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-            self.table.setItem(row, 1, name_item)
-
-            color_item = ColorButton()
-            color_item.changed.connect(self.handle_item_clicked)
-            self.table.setCellWidget(row, 2, color_item)
-
-        for frame in self.frames:
-            for i, contour_sequence in enumerate(self.contour_frame.contours_sequences):
-                mask = np.zeros(frame.hu_img.shape, dtype=int)
-                for contour_instance in contour_sequence:
-                    if frame.sup_uid == contour_instance.ContourImageSequence[0].ReferencedSOPInstanceUID:
-                        contour_raw = contour_instance.ContourData
-                        contour = np.asarray(contour_raw).reshape((3, -1), order="F")[:-1].ravel(order="F").reshape(
-                            (-1, 2))
-                        contour -= np.asarray(self.frames[self.value].file.ImagePositionPatient[:-1])
-                        contour *= np.array([self.frames[self.value].file.ImageOrientationPatient[0],
-                                             self.frames[self.value].file.ImageOrientationPatient[4]])
-                        contour /= np.asarray(self.frames[self.value].file.PixelSpacing)
-                        contour = np.concatenate((contour, [contour[0]]))
-                        update_mask(mask, contour)
-                        frame.contours[names[i]].append(contour.reshape(-1, 1, 2))
-                frame.contours_masks[names[i]] = np.array(mask % 2, dtype=bool)
+            self.add_row(row, name)
+
+        all_properties = build_rois(self.contour_frame, self.volume, self.mask_cache)
 
         for row, name in enumerate(names):
-            properties = ContourProperty(name, self.frames)
-            properties.add_to_table(self.table, row)
+            properties = all_properties[name]
+            self.add_properties(row, properties)
             self.contour_frame.contours_properties[name] = properties
+        self.table.blockSignals(False)
+        self.overlay = Overlay(self.volume)
+
+    def add_row(self, row, name):
+        self.table.insertRow(row)
+
+        id_item = QTableWidgetItem()
+        id_item.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        id_item.setText(self.get_id())
+        id_item.setCheckState(Qt.Unchecked)
+        self.table.setItem(row, 0, id_item)
+
+        name_item = QTableWidgetItem(name)
+        name_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        self.table.setItem(row, 1, name_item)
+
+        color_item = ColorButton()
+        color_item.changed.connect(lambda name=name: self.handle_item_clicked(name))
+        self.table.setCellWidget(row, 2, color_item)
+
+    @Slot()
+    def add_contour(self):
+        from Masks import ContourProperty, HuAccumulator, SparseMask
+
+        if self.overlay is None:
+            return
+        i = 1
+        while f"Contour {i}" in self.contour_frame.contours_names:
+            i += 1
+        name = f"Contour {i}"
+        self.volume.contours[name] = {}
+        self.volume.masks[name] = SparseMask(self.volume.shape)
+        self.append_structure(name, ContourProperty(name, HuAccumulator(len(self.volume))))
+        self.start_drawing(name)
+
+    @Slot()
+    def derive_structure(self):
+        # Union, intersection and difference combine the selected rows in table order, a margin grows or shrinks
+        # the first selected row.
+        from RoiAlgebra import OPERATIONS, derive, add_structure
+
+        if self.overlay is None:
+            return
+        rows = sorted({x.row() for x in self.table.selectedIndexes()})
+        names = [self.contour_frame.contours_names[row] for row in rows]
+        if not names:
+            message = QMessageBox()
+            message.setText("Select a contour first!")
+            message.exec()
+            return
+        operation, accepted = QInputDialog.getItem(self, "Derive structure", "Operation:", OPERATIONS, 0, False)
+        if not accepted:
+            return
+
+        distance = 0
+        if operation == "Margin":
+            distance, accepted = QInputDialog.getDouble(self, "Derive structure", "Margin in mm (negative shrinks):",
+                                                        5, -100, 100, 1)
+            if not accepted or distance == 0:
+                return
+            name = f"{names[0]} {distance:+g} mm"
+        elif len(names) < 2:
+            message = QMessageBox()
+            message.setText("Select at least two contours!")
+            message.exec()
+            return
+        else:
+            name = {"Union": " | ", "Intersection": " & ", "Difference": " - "}[operation].join(names)
+
+        name = self.unique_name(name)
+        mask = derive(self.volume, operation, names, distance)
+        self.append_structure(name, add_structure(self.volume, name, mask))
+        self.change_img(self.value)
+
+    def unique_name(self, name):
+        i = 1
+        unique = name
+        while unique in self.contour_frame.contours_names:
+            i += 1
+            unique = f"{name} ({i})"
+        return unique
+
+    def append_structure(self, name, properties):
+        # A new ROI created in the application, shown as a checked row at the end of the table.
+        names = self.contour_frame.contours_names
+        names.append(name)
+        self.contour_frame.contours_properties[name] = properties
+        self.update_dose(name)
+
+        row = len(names) - 1
+        self.table.blockSignals(True)
+        self.add_row(row, name)
+        self.add_properties(row, properties)
+        self.table.item(row, 0).setCheckState(Qt.Checked)
+        self.table.blockSignals(False)
+        self.table.selectRow(row)
+
+    @Slot()
+    def add_area(self):
+        if self.overlay is None:
+            return
+        row = self.table.currentRow()
+        if row < 0:
+            message = QMessageBox()
+            message.setText("Select a contour first!")
+            message.exec()
+            return
+        self.start_drawing(self.contour_frame.contours_names[row])
+
+    def start_drawing(self, name):
+        self.drawing = name
+        self.points = []
+        self.status.setText(f"Drawing {name}: left click adds a point, right click closes the area")
+
+    def finish_drawing(self):
+        # Only the current slice of the edited ROI is re-rasterized and its statistics updated in place.
+        from Masks import add_polygon
+
+        name, points = self.drawing, self.points
+        self.drawing = None
+        self.points = []
+        if len(points) >= 3:
+            add_polygon(self.volume, self.contour_frame.contours_properties[name], name, self.value, points)
+            self.update_dose(name)
+            self.overlay.invalidate(name)
+            for view in self.sections:
+                if view.overlay is not None:
+                    view.overlay.invalidate(name)
+            row = self.contour_frame.contours_names.index(name)
+            self.table.blockSignals(True)
+            self.add_properties(row, self.contour_frame.contours_properties[name])
+            self.table.blockSignals(False)
+        self.change_img(self.value)
+
+    def image_position(self, position):
+        # Maps a point on the preview label to pixel coordinates of the slice under the scaled, centered pixmap.
+        pixmap = self.preview.pixmap()
+        if pixmap is None or pixmap.isNull():
+            return None
+        left = (self.preview.width() - pixmap.width()) / 2
+        top = (self.preview.height() - pixmap.height()) / 2
+        x = (position.x() - left) * self.volume.shape[2] / pixmap.width() - 0.5
+        y = (position.y() - top) * self.volume.shape[1] / pixmap.height() - 0.5
+        if not (-0.5 <= x <= self.volume.shape[2] - 0.5 and -0.5 <= y <= self.volume.shape[1] - 0.5):
+            return None
+        return x, y
+
+    def eventFilter(self, watched, event):
+        if watched is self.preview and self.drawing is not None and event.type() == QEvent.MouseButtonPress:
+            if event.button() == Qt.LeftButton:
+                point = self.image_position(event.position())
+                if point is not None:
+                    self.points.append(point)
+                    self.show_image()
+            elif event.button() == Qt.RightButton:
+                self.finish_drawing()
+            return True
+        return super().eventFilter(watched, event)
+
+    def add_properties(self, row, properties):
+        mean_item = QTableWidgetItem(f"{properties.mean:.2f}")
+        mean_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        self.table.setItem(row, 5, mean_item)
+
+        std_item = QTableWidgetItem(f"{properties.std:.2f}")
+        std_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        self.table.setItem(row, 6, std_item)
+
+        min_item = QTableWidgetItem(f"{int(properties.min)}" if properties.volume else "-")
+        min_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        self.table.setItem(row, 3, min_item)
+
+        max_item = QTableWidgetItem(f"{int(properties.max)}" if properties.volume else "-")
+        max_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        self.table.setItem(row, 4, max_item)
+
+        median_item = QTableWidgetItem(str(properties.median))
+        median_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        self.table.setItem(row, 7, median_item)
+
+        volume_item = QTableWidgetItem(str(properties.volume))
+        volume_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        self.table.setItem(row, 8, volume_item)
+
+        self.add_dose(row, properties.name)
+
+    def add_dose(self, row, name):
+        # Dose columns stay empty until an RT dose is loaded for the study.
+        histogram = self.contour_frame.contours_dvhs.get(name)
+        values = histogram.values() if histogram is not None else {}
+        for column, key in enumerate(("dmean", "dmax", "d95", "v20"), 9):
+            value = values.get(key)
+            item = QTableWidgetItem("-" if value is None or value != value else f"{value:.2f}")
+            item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+            self.table.setItem(row, column, item)
 
     def get_id(self):
         i = 0
@@ -208,41 +859,54 @@ class MainWindow(QWidget):
         code = "".join([self.alphabet[i] for i in temp_code])
         return code[::-1]
 
-    @Slot()
-    def update_contours(self):
-        indices = []
+    def visible_layers(self):
+        layers = []
         for cell in range(self.table.rowCount()):
             if self.table.item(cell, 0).checkState() == Qt.Checked:
-                indices.append(cell)
-
-        alpha = 0.7
-
-        for i in indices:
-            if self.contour_frame.contours_names[i] in self.frames[self.value].contours:
-                color = self.table.cellWidget(i, 2).color.getRgb()
-                names = self.contour_frame.contours_names[i]
-
-                contours_to_draw = [np.rint(x).astype(int) for x in self.frames[self.value].contours[names]]
-                bit_mask = self.frames[self.value].contours_masks[names]
-                color_mask = np.stack([bit_mask * 255, bit_mask * color[0], bit_mask * color[1], bit_mask * color[2]], axis=-1)
-                color_mask = (255 * color_mask).astype(np.uint8)
+                layers.append((self.contour_frame.contours_names[cell], self.table.cellWidget(cell, 2).color.getRgb()))
+        return layers
 
-                new_image = cv2.addWeighted(self.image, alpha, color_mask, 1 - alpha, 0)
-                self.image = np.where(np.stack([bit_mask, bit_mask, bit_mask, bit_mask], axis=-1) == 0,
-                                      self.image, new_image)
+    @Slot()
+    def update_contours(self):
+        if self.overlay is not None:
+            with PROFILER.measure("update_contours"):
+                self.image = self.overlay.compose(self.value, self.image, self.visible_layers())
+
+    def update_contour(self, name):
+        if self.overlay is not None and self.image is not None:
+            with PROFILER.measure("update_contours"):
+                self.image = self.overlay.update(self.visible_layers(), name)
+                self.show_image()
+            self.update_status()
+            self.update_section()
+
+    def update_status(self):
+        text = PROFILER.status(STATUS_STAGES)
+        if len(self.session):
+            text += f" | {len(self.session)} studies, {self.session.memory() / 1024 ** 2:.0f} MB in RAM"
+        self.status.setText(text)
 
-                cv2.drawContours(self.image, contours_to_draw, -1, color, 1, cv2.LINE_AA)
+    @Slot()
+    def show_diagnostics(self):
+        message = QMessageBox()
+        message.setWindowTitle("MaksContours - diagnostics")
+        message.setText("Stage timings")
+        message.setInformativeText(f"<pre>{PROFILER.summary()}</pre>")
+        message.exec()
 
     @Slot()
-    def handle_item_checked(self, _, column):
-        if column == 0 or column == 2:
-            self.change_img(self.value)
+    def handle_item_checked(self, row, column):
+        if column == 0:
+            self.update_contour(self.contour_frame.contours_names[row])
 
     @Slot()
-    def handle_item_clicked(self):
-        self.change_img(self.value)
+    def handle_item_clicked(self, name):
+        self.update_contour(name)
+
 
+if __name__ == "__main__":
+    app = QApplication()
+    window = MainWindow()
+    QTimer.singleShot(0, preload)
+    app.exec()
 
-app = QApplication()
-window = MainWindow()
-app.exec()
@@ -1,58 +1,420 @@
 import numpy as np
-from PySide6.QtCore import Qt
-from skimage.measure import points_in_poly
-from PySide6.QtWidgets import QTableWidgetItem
+from collections import defaultdict
+from Instrumentation import PROFILER, timed
 
 
-def update_mask(mask, contour):
-    left = int(np.amin(contour[:, 0])) - 1
-    right = int(np.amax(contour[:, 0])) + 1
-    top = int(np.amin(contour[:, 1])) - 1
-    bot = int(np.amax(contour[:, 1])) + 1
+def update_mask(mask, contour, origin=(0, 0)):
+    # Adds 1 inside the polygon, so overlapping contours accumulate and mask % 2 gives holes / nested contours.
+    # The mask covers the slice from row, column origin on.
+    row, column = origin
+    left = max(int(np.amin(contour[:, 0])) - 1, column)
+    right = min(int(np.amax(contour[:, 0])) + 1, column + mask.shape[1])
+    top = max(int(np.amin(contour[:, 1])) - 1, row)
+    bot = min(int(np.amax(contour[:, 1])) + 1, row + mask.shape[0])
+    if left >= right or top >= bot:
+        return
 
-    for y in range(top, bot):
-        for x in range(left, right):
-            if points_in_poly([(x, y)], contour):
-                mask[y, x] += 1
+    inside = polygon_mask(contour, left, top, right - left, bot - top)
+    mask[top - row:bot - row, left - column:right - column] += inside
 
 
-class ContourProperty:
-    def __init__(self, name, frames):
-        total_voxels = []
-        for frame in frames:
-            total_voxels.extend(frame.hu_img[frame.contours_masks[name]])
-
-        self.mean = np.mean(total_voxels)
-        self.std = np.std(total_voxels)
-        self.median = np.median(total_voxels)
-        self.min = np.amin(total_voxels)
-        self.max = np.amax(total_voxels)
-        self.volume = len(total_voxels)
+def polygon_mask(contour, left, top, width, height):
+    # Scanline version of skimage.measure.points_in_poly for every pixel of [left, left + width) x [top, top + height):
+    # a pixel is inside when an odd number of edges cross its row strictly to the right, and on the boundary (which
+    # also counts as inside) when the parity of crossings to the left differs or when it is a vertex.
+    contour = np.asarray(contour, dtype=np.float64)
+    xp, yp = contour[:, 0], contour[:, 1]
+    xq, yq = np.roll(xp, 1), np.roll(yp, 1)
+
+    ys = np.arange(top, top + height, dtype=np.float64)[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xi = (xq - xp) * (ys - yp) / (yq - yp) + xp
+
+    # Edges with one end above the row and the other at or below it count the crossings to the right; edges with
+    # one end below the row and the other at or above it count the crossings to the left.
+    right_edges = (yp > ys) != (yq > ys)
+    left_edges = (yp < ys) != (yq < ys)
+    right_total = np.count_nonzero(right_edges, axis=1)[:, None]
+    right_count = right_total - _count_left_of(xi, right_edges, np.ceil, 0, left, width)
+    left_count = _count_left_of(xi, left_edges, np.floor, 1, left, width)
+    inside = (right_count % 2 == 1) | (left_count % 2 == 1)
+
+    vertices = (np.abs(xp - np.rint(xp)) < 1e-12) & (np.abs(yp - np.rint(yp)) < 1e-12)
+    rows = np.rint(yp[vertices]).astype(np.intp) - top
+    columns = np.rint(xp[vertices]).astype(np.intp) - left
+    valid = (rows >= 0) & (rows < height) & (columns >= 0) & (columns < width)
+    inside[rows[valid], columns[valid]] = True
+
+    return inside
+
+
+def _count_left_of(xi, edges, rounding, offset, left, width):
+    # For every pixel of every row count the crossings whose rounded position is at or before its column, by
+    # histogramming the crossings per row and taking a cumulative sum along the row.
+    rows, columns = np.nonzero(edges)
+    columns = np.clip(rounding(xi[rows, columns]) + offset - left, 0, width).astype(np.intp)
+    height = edges.shape[0]
+    counts = np.bincount(rows * (width + 1) + columns, minlength=height * (width + 1))
+    return np.cumsum(counts.reshape(height, width + 1)[:, :-1], axis=1)
+
+
+class SparseMask:
+    # A 3D ROI mask stored as the bounding box and bit-packed rows of every slice the ROI is on. Slices are expanded
+    # on access, so memory depends on the size of the ROI instead of the size of the series.
+    def __init__(self, shape):
+        self.shape = tuple(int(x) for x in shape)
+        self.boxes = {}
+        self.bits = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, n):
+        mask = np.zeros(self.shape[1:], dtype=bool)
+        region = self.crop(n)
+        if region is not None:
+            top, bottom, left, right, cropped = region
+            mask[top:bottom, left:right] = cropped
+        return mask
+
+    def __setitem__(self, n, mask):
+        self.set_region(n, (0, 0), mask)
+
+    def set_region(self, n, origin, mask):
+        # Stores mask, whose first pixel is at row, column origin of the slice, as slice n.
+        rows = np.flatnonzero(mask.any(axis=1))
+        if rows.size == 0:
+            self.boxes.pop(n, None)
+            self.bits.pop(n, None)
+            return
+        columns = np.flatnonzero(mask.any(axis=0))
+        mask = mask[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+        self.boxes[n] = (origin[0] + rows[0], origin[1] + columns[0], *mask.shape)
+        self.bits[n] = np.packbits(mask, axis=1)
+
+    def crop(self, n):
+        # Top, bottom, left, right and the mask inside that box, None when the ROI is not on slice n.
+        if n not in self.bits:
+            return None
+        top, left, height, width = self.boxes[n]
+        return top, top + height, left, left + width, np.unpackbits(self.bits[n], axis=1, count=width).view(bool)
+
+    def section(self, axis, index):
+        # Mask on the plane through row (axis 1) or column (axis 2) index of every slice, one row per slice: first,
+        # last + 1 slice, left, right and the mask inside that box, None when the ROI does not cross the plane. Only
+        # the packed bytes on the plane are read.
+        lines = {}
+        for n, (top, left, height, width) in self.boxes.items():
+            if axis == 1 and top <= index < top + height:
+                line = np.unpackbits(self.bits[n][index - top], count=width).view(bool)
+                start = left
+            elif axis == 2 and left <= index < left + width:
+                column = index - left
+                line = (self.bits[n][:, column >> 3] >> (7 - (column & 7)) & 1).view(bool)
+                start = top
+            else:
+                continue
+            if line.any():
+                lines[n] = (start, line)
+        if not lines:
+            return None
+
+        first, last = min(lines), max(lines) + 1
+        left = min(start for start, _ in lines.values())
+        right = max(start + len(line) for start, line in lines.values())
+        mask = np.zeros((last - first, right - left), dtype=bool)
+        for n, (start, line) in lines.items():
+            mask[n - first, start - left:start - left + len(line)] = line
+        return first, last, left, right, mask
+
+    def slices(self):
+        return sorted(self.bits)
+
+    def box(self):
+        # Bounding box over all slices as first, last + 1 slice, top, bottom, left, right; zeros when empty.
+        if not self.bits:
+            return np.zeros(6, dtype=int)
+        slices = self.slices()
+        boxes = np.array([self.boxes[n] for n in slices])
+        return np.array([slices[0], slices[-1] + 1, boxes[:, 0].min(), (boxes[:, 0] + boxes[:, 2]).max(),
+                         boxes[:, 1].min(), (boxes[:, 1] + boxes[:, 3]).max()])
+
+    def dense(self, box=None):
+        box = (0, self.shape[0], 0, self.shape[1], 0, self.shape[2]) if box is None else box
+        masks = np.zeros((box[1] - box[0], box[3] - box[2], box[5] - box[4]), dtype=bool)
+        for n in self.bits:
+            if box[0] <= n < box[1]:
+                # Only the part of the slice's box inside the requested box is copied.
+                top, bottom, left, right, cropped = self.crop(n)
+                t, b, l, r = max(top, box[2]), min(bottom, box[3]), max(left, box[4]), min(right, box[5])
+                if t < b and l < r:
+                    masks[n - box[0], t - box[2]:b - box[2], l - box[4]:r - box[4]] = \
+                        cropped[t - top:b - top, l - left:r - left]
+        return masks
+
+    @classmethod
+    def from_dense(cls, masks, shape=None, box=(0, 0, 0, 0, 0, 0)):
+        # masks covers the region of the volume starting at the first slice, top and left of box.
+        sparse = cls(masks.shape if shape is None else shape)
+        for i in np.flatnonzero(masks.any(axis=(1, 2))):
+            sparse.set_region(box[0] + i, (box[2], box[4]), masks[i])
+        return sparse
+
+    def count(self):
+        return sum(int(np.unpackbits(x).sum()) for x in self.bits.values())
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in self.bits.values())
+
+    def state(self):
+        slices = self.slices()
+        return {"slices": np.array(slices, dtype=np.int64),
+                "boxes": np.array([self.boxes[n] for n in slices], dtype=np.int64).reshape(-1, 4),
+                "bits": np.concatenate([self.bits[n].ravel() for n in slices]) if slices else np.zeros(0, np.uint8)}
+
+    @classmethod
+    def from_state(cls, shape, state):
+        sparse = cls(shape)
+        start = 0
+        for n, box in zip(state["slices"], state["boxes"]):
+            height, row_bytes = int(box[2]), (int(box[3]) + 7) // 8
+            sparse.boxes[int(n)] = tuple(int(x) for x in box)
+            sparse.bits[int(n)] = state["bits"][start:start + height * row_bytes].reshape(height, row_bytes)
+            start += height * row_bytes
+        return sparse
+
+
+class ContourIndex:
+    def __init__(self, contour_frame, volume):
+        self.frame_indices = {uid: n for n, uid in enumerate(volume.uids)}
+        self.z_positions = volume.z
+        self.z_tolerance = volume.slice_thickness() / 2
+
+        # Patient -> pixel transform of every slice, taken from the slice's own geometry.
+        self.origins = volume.origins[:, :-1]
+        self.orientations = volume.orientations[:, [0, 4]]
+        self.spacings = volume.spacings
+
+        # ROI name -> slice index -> closed contours in pixel coordinates.
+        self.contours = {}
+        for name, contour_sequence in zip(contour_frame.contours_names, contour_frame.contours_sequences):
+            slices = defaultdict(list)
+            for contour_instance in contour_sequence:
+                n = self.find_frame(contour_instance)
+                if n is not None:
+                    slices[n].append(self.to_pixels(contour_instance.ContourData, n))
+            self.contours[name] = slices
 
+    def find_frame(self, contour_instance):
+        if contour_instance.get("ContourImageSequence"):
+            uid = contour_instance.ContourImageSequence[0].get("ReferencedSOPInstanceUID")
+            if uid in self.frame_indices:
+                return self.frame_indices[uid]
+
+        if len(self.z_positions) == 0:
+            return None
+        z = float(contour_instance.ContourData[2])
+        n = int(np.argmin(np.abs(self.z_positions - z)))
+        if abs(self.z_positions[n] - z) <= self.z_tolerance:
+            return n
+        return None
+
+    def to_pixels(self, contour_raw, n):
+        contour = np.asarray(contour_raw, dtype=np.float64).reshape((-1, 3))[:, :2]
+        contour -= self.origins[n]
+        contour *= self.orientations[n]
+        # PixelSpacing is row (y), column (x) spacing.
+        contour /= self.spacings[n][::-1]
+        return np.concatenate((contour, [contour[0]]))
+
+    def slices(self, name):
+        return self.contours.get(name, {})
+
+
+class HuAccumulator:
+    # Per-slice voxel counts, sums and extrema plus one integer-HU histogram for the median, so memory does not
+    # depend on the size of the ROI.
+    def __init__(self, slices):
+        self.counts = np.zeros(slices, dtype=np.int64)
+        self.sums = np.zeros(slices)
+        self.squares = np.zeros(slices)
+        self.minima = np.full(slices, np.inf)
+        self.maxima = np.full(slices, -np.inf)
+        self.histogram = np.zeros(0, dtype=np.int64)
+        self.offset = 0
+
+    STATE = ("counts", "sums", "squares", "minima", "maxima", "histogram")
+
+    @classmethod
+    def from_state(cls, state):
+        accumulator = cls(0)
+        for field in cls.STATE:
+            setattr(accumulator, field, state[field])
+        accumulator.offset = int(state["offset"])
+        return accumulator
+
+    def state(self):
+        return {**{field: getattr(self, field) for field in self.STATE}, "offset": np.array(self.offset)}
+
+    @staticmethod
+    def bins(raw, slope, intercept):
+        raw = raw.astype(np.int64)
+        low = raw.min()
+        counts = np.bincount(raw - low)
+        present = counts > 0
+        return (np.flatnonzero(present) + low) * slope + intercept, counts[present]
+
+    def add(self, n, raw, slope, intercept):
+        if raw.size == 0:
+            return
+        levels, counts = self.bins(raw, slope, intercept)
+
+        self.counts[n] += raw.size
+        self.sums[n] += counts @ levels
+        self.squares[n] += counts @ (levels * levels)
+        self.minima[n] = min(self.minima[n], levels.min())
+        self.maxima[n] = max(self.maxima[n], levels.max())
+        self.add_histogram(np.rint(levels).astype(np.int64), counts)
+
+    def add_histogram(self, levels, counts):
+        low, high = int(levels.min()), int(levels.max())
+        if self.histogram.size == 0:
+            self.offset = low
+            self.histogram = np.zeros(high - low + 1, dtype=np.int64)
+        elif low < self.offset or high >= self.offset + self.histogram.size:
+            new_low = min(low, self.offset)
+            new_high = max(high, self.offset + self.histogram.size - 1)
+            histogram = np.zeros(new_high - new_low + 1, dtype=np.int64)
+            histogram[self.offset - new_low:self.offset - new_low + self.histogram.size] = self.histogram
+            self.histogram = histogram
+            self.offset = new_low
+        np.add.at(self.histogram, levels - self.offset, counts)
+
+    def remove(self, n, raw, slope, intercept):
+        # Drops the whole contribution of slice n; raw must be the values that were added for it.
+        if raw.size:
+            levels, counts = self.bins(raw, slope, intercept)
+            np.subtract.at(self.histogram, np.rint(levels).astype(np.int64) - self.offset, counts)
+        self.counts[n] = 0
+        self.sums[n] = 0
+        self.squares[n] = 0
+        self.minima[n] = np.inf
+        self.maxima[n] = -np.inf
+
+    def median(self, count):
+        cumulative = np.cumsum(self.histogram)
+        lower = np.searchsorted(cumulative, (count - 1) // 2, side="right")
+        upper = np.searchsorted(cumulative, count // 2, side="right")
+        return (lower + upper) / 2 + self.offset
+
+    def values(self):
+        count = int(self.counts.sum())
+        if count == 0:
+            return {"min": np.nan, "max": np.nan, "mean": np.nan, "std": np.nan, "median": np.nan, "volume": 0}
+        mean = self.sums.sum() / count
+        return {"min": self.minima.min(), "max": self.maxima.max(), "mean": mean,
+                "std": np.sqrt(max(self.squares.sum() / count - mean * mean, 0)),
+                "median": np.float64(self.median(count)), "volume": count}
+
+
+@timed("statistics")
+def contour_properties(volume, names):
+    # One sweep over the volume: every slice is read once and shared by all ROIs.
+    accumulators = {name: HuAccumulator(len(volume)) for name in names}
+    for n in range(len(volume)):
+        pixels = volume.pixels[n]
+        for name in names:
+            region = volume.masks[name].crop(n)
+            if region is not None:
+                top, bottom, left, right, mask = region
+                accumulators[name].add(n, pixels[top:bottom, left:right][mask], volume.slopes[n], volume.intercepts[n])
+    return {name: ContourProperty(name, accumulators[name]) for name in names}
+
+
+class ContourProperty:
+    def __init__(self, name, accumulator):
         self.name = name
+        self.accumulator = accumulator
+        self.update()
+
+    def update(self):
+        self.__dict__.update(self.accumulator.values())
+
+    def values(self):
+        return {"min": self.min, "max": self.max, "mean": self.mean, "std": self.std, "median": self.median,
+                "volume": self.volume}
+
+
+def rasterize_slice(slice_contours, shape):
+    # Even-odd fill of the contours of one slice, computed over their common bounding box only. Returns the
+    # row, column origin of the box and the mask inside it.
+    points = np.concatenate(slice_contours)
+    left = max(int(np.amin(points[:, 0])) - 1, 0)
+    right = min(int(np.amax(points[:, 0])) + 1, shape[1])
+    top = max(int(np.amin(points[:, 1])) - 1, 0)
+    bot = min(int(np.amax(points[:, 1])) + 1, shape[0])
+    mask = np.zeros((max(bot - top, 0), max(right - left, 0)), dtype=np.int32)
+    for contour in slice_contours:
+        update_mask(mask, contour, (top, left))
+    return (top, left), mask % 2 == 1
+
+
+def rasterize(slices, shape):
+    masks = SparseMask(shape)
+    for n, slice_contours in slices.items():
+        masks.set_region(n, *rasterize_slice(slice_contours, shape[1:]))
+    return masks
+
 
-    def add_to_table(self, table, row):
-        mean_item = QTableWidgetItem(f"{self.mean:.2f}")
-        mean_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-        table.setItem(row, 5, mean_item)
+@timed("edit_slice")
+def replace_slice(volume, properties, name, n, mask):
+    # Moves the statistics of slice n from the old mask to the new one instead of sweeping the whole volume.
+    pixels = volume.pixels[n]
+    region = volume.masks[name].crop(n)
+    if region is not None:
+        top, bottom, left, right, old_mask = region
+        properties.accumulator.remove(n, pixels[top:bottom, left:right][old_mask], volume.slopes[n],
+                                      volume.intercepts[n])
+    properties.accumulator.add(n, pixels[mask], volume.slopes[n], volume.intercepts[n])
+    properties.update()
+    volume.masks[name][n] = mask
 
-        std_item = QTableWidgetItem(f"{self.std:.2f}")
-        std_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-        table.setItem(row, 6, std_item)
 
-        min_item = QTableWidgetItem(f"{int(self.min)}")
-        min_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-        table.setItem(row, 3, min_item)
+def add_polygon(volume, properties, name, n, polygon):
+    # The drawn area is added to the ROI on one slice; only that slice is rasterized.
+    polygon = np.asarray(polygon, dtype=np.float64)
+    polygon = np.concatenate((polygon, polygon[:1]))
+    mask = volume.masks[name][n]
+    (top, left), area = rasterize_slice([polygon], volume.shape[1:])
+    mask[top:top + area.shape[0], left:left + area.shape[1]] |= area
+    replace_slice(volume, properties, name, n, mask)
+    volume.contours[name].setdefault(n, []).append(polygon.reshape(-1, 1, 2))
 
-        max_item = QTableWidgetItem(f"{int(self.max)}")
-        max_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-        table.setItem(row, 4, max_item)
 
-        median_item = QTableWidgetItem(str(self.median))
-        median_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-        table.setItem(row, 7, median_item)
+def build_rois(contour_frame, volume, cache=None):
+    # Fills volume.contours and volume.masks for every ROI of the structure set and returns their properties.
+    names = contour_frame.contours_names
+    with PROFILER.measure("contour_matching"):
+        index = ContourIndex(contour_frame, volume)
+        for name in names:
+            volume.contours[name] = {n: [contour.reshape(-1, 1, 2) for contour in slice_contours]
+                                     for n, slice_contours in index.slices(name).items()}
 
-        volume_item = QTableWidgetItem(str(self.volume))
-        volume_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-        table.setItem(row, 8, volume_item)
+    key = cache.key(contour_frame, volume) if cache is not None else None
+    cached = cache.load(key, names, volume.shape) if cache is not None else None
+    if cached is not None:
+        volume.masks, accumulators = cached
+        return {name: ContourProperty(name, accumulators[name]) for name in names}
 
+    with PROFILER.measure("rasterization"):
+        for name in names:
+            volume.masks[name] = rasterize(index.slices(name), volume.shape)
+    properties = contour_properties(volume, names)
+    if cache is not None:
+        try:
+            cache.save(key, names, volume.shape, volume.masks,
+                       {name: properties[name].accumulator for name in names})
+        except OSError:
+            pass
+    return properties
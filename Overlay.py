@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import numpy as np
+import cv2
+from Volume import AXIAL
+
+# Anti-aliased outlines reach this many pixels outside the mask they surround.
+OUTLINE_MARGIN = 2
+# ROI regions and outlines kept per overlay, one per ROI and plane; the least recently used are dropped first.
+CACHE_REGIONS = 2048
+
+
+class Overlay:
+    def __init__(self, volume, alpha=0.7, axis=AXIAL, capacity=CACHE_REGIONS):
+        # Composes the planes across one axis of the volume; see Volume.section.
+        self.volume = volume
+        self.alpha = alpha
+        self.axis = axis
+        self.capacity = capacity
+        self.regions = OrderedDict()
+        self.outlines = OrderedDict()
+
+        self.n = None
+        self.base = None
+        self.image = None
+        self.layers = []
+
+    def region(self, name, n):
+        # Bounding box of an ROI's fill and outline on one slice with the cropped mask, None when it is absent.
+        key = (name, n)
+        if key in self.regions:
+            self.regions.move_to_end(key)
+            return self.regions[key]
+        if self.axis != AXIAL:
+            return self.store(self.regions, key, self.section_region(name, n))
+
+        outline = self.outline(name, n)
+        cropped = self.volume.masks[name].crop(n)
+        if len(outline) == 0 and cropped is None:
+            return self.store(self.regions, key, None)
+
+        boxes = [cropped[:4]] if cropped is not None else []
+        if len(outline):
+            points = np.concatenate([x.reshape(-1, 2) for x in outline])
+            boxes.append((points[:, 1].min(), points[:, 1].max() + 1,
+                          points[:, 0].min(), points[:, 0].max() + 1))
+        height, width = self.volume.shape[1:]
+        top = max(min(x[0] for x in boxes), 0)
+        bottom = min(max(x[1] for x in boxes), height)
+        left = max(min(x[2] for x in boxes), 0)
+        right = min(max(x[3] for x in boxes), width)
+        mask = np.zeros((max(bottom - top, 0), max(right - left, 0)), dtype=bool)
+        if cropped is not None:
+            mask_top, mask_bottom, mask_left, mask_right, fill = cropped
+            mask[mask_top - top:mask_bottom - top, mask_left - left:mask_right - left] = fill
+        return self.store(self.regions, key, (top, bottom, left, right, mask))
+
+    def section_region(self, name, n):
+        # Coronal and sagittal planes have the last slice in the top row.
+        section = self.volume.masks[name].section(self.axis, n)
+        if section is None:
+            return None
+        first, last, left, right, mask = section
+        slices = len(self.volume)
+        return slices - last, slices - first, left, right, mask[::-1]
+
+    def outline(self, name, n):
+        # Contour polygons on axial slices, the boundary of the resliced mask on the other planes.
+        key = (name, n)
+        if key in self.outlines:
+            self.outlines.move_to_end(key)
+            return self.outlines[key]
+        if self.axis == AXIAL:
+            return self.store(self.outlines, key,
+                              [np.rint(x).astype(int) for x in self.volume.contours.get(name, {}).get(n, [])])
+        region = self.region(name, n)
+        if region is None:
+            return self.store(self.outlines, key, [])
+        top, _, left, _, mask = region
+        found, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE,
+                                    offset=(int(left), int(top)))
+        return self.store(self.outlines, key, list(found))
+
+    def store(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.capacity:
+            cache.popitem(last=False)
+        return value
+
+    def invalidate(self, name):
+        for cache in (self.regions, self.outlines):
+            for key in [key for key in cache if key[0] == name]:
+                del cache[key]
+
+    def compose(self, n, base, layers):
+        self.n = n
+        self.base = base
+        self.layers = list(layers)
+        self.image = base.copy()
+        self.compose_region(0, base.shape[0], 0, base.shape[1])
+        return self.image
+
+    def update(self, layers, name):
+        # Recomposite only the part of the image covered by one ROI whose visibility or color has changed.
+        self.layers = list(layers)
+        region = self.region(name, self.n)
+        if region is None or self.image is None:
+            return self.image
+
+        top, bottom, left, right, _ = region
+        self.compose_region(max(top - OUTLINE_MARGIN, 0), min(bottom + OUTLINE_MARGIN, self.base.shape[0]),
+                            max(left - OUTLINE_MARGIN, 0), min(right + OUTLINE_MARGIN, self.base.shape[1]))
+        return self.image
+
+    def compose_region(self, top, bottom, left, right):
+        # All layers are blended into one float buffer and rounded once; outlines are drawn on top of all fills.
+        composite = self.base[top:bottom, left:right].astype(np.float32)
+        visible = []
+        for name, color in self.layers:
+            region = self.region(name, self.n)
+            if region is None:
+                continue
+            visible.append((name, color))
+            r_top, r_bottom, r_left, r_right, mask = region
+            t, b, l, r = max(top, r_top), min(bottom, r_bottom), max(left, r_left), min(right, r_right)
+            if t >= b or l >= r:
+                continue
+            inside = mask[t - r_top:b - r_top, l - r_left:r - r_left]
+            target = composite[t - top:b - top, l - left:r - left]
+            target[inside] = target[inside] * self.alpha + np.asarray(color, dtype=np.float32) * (1 - self.alpha)
+
+        composite = np.ascontiguousarray(np.clip(np.rint(composite), 0, 255).astype(np.uint8))
+        for name, color in visible:
+            cv2.drawContours(composite, self.outline(name, self.n), -1, color, 1, cv2.LINE_AA,
+                             offset=(-int(left), -int(top)))
+        self.image[top:bottom, left:right] = composite
@@ -0,0 +1,141 @@
+import math
+import numpy as np
+import cv2
+from scipy import ndimage
+from Instrumentation import timed
+from Masks import SparseMask, contour_properties
+
+OPERATIONS = ("Union", "Intersection", "Difference", "Margin")
+
+
+def union_box(boxes):
+    boxes = np.array(boxes)
+    return np.array([boxes[:, 0].min(), boxes[:, 1].max(), boxes[:, 2].min(), boxes[:, 3].max(),
+                     boxes[:, 4].min(), boxes[:, 5].max()])
+
+
+def union(masks):
+    shape = masks[0].shape
+    masks = [x for x in masks if x.bits]
+    if not masks:
+        return SparseMask(shape)
+    box = union_box([x.box() for x in masks])
+    result = masks[0].dense(box)
+    for mask in masks[1:]:
+        result |= mask.dense(box)
+    return SparseMask.from_dense(result, shape, box)
+
+
+def intersection(masks):
+    if any(not x.bits for x in masks):
+        return SparseMask(masks[0].shape)
+    boxes = np.array([x.box() for x in masks])
+    box = np.array([boxes[:, 0].max(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].min(),
+                    boxes[:, 4].max(), boxes[:, 5].min()])
+    if (box[1::2] <= box[::2]).any():
+        return SparseMask(masks[0].shape)
+    result = masks[0].dense(box)
+    for mask in masks[1:]:
+        result &= mask.dense(box)
+    return SparseMask.from_dense(result, masks[0].shape, box)
+
+
+def difference(mask, others):
+    if not mask.bits:
+        return SparseMask(mask.shape)
+    box = mask.box()
+    result = mask.dense(box)
+    for other in others:
+        result &= ~other.dense(box)
+    return SparseMask.from_dense(result, mask.shape, box)
+
+
+def planar_distances(masks, pixel_spacing):
+    # Squared distance from every pixel to the nearest zero pixel of its slice, and the factor turning it into mm^2.
+    # With square pixels the values are exact integers in pixel units; slices without zeros are infinitely far.
+    row, column = pixel_spacing
+    distances = np.zeros(masks.shape, dtype=np.float32)
+    for i in np.flatnonzero(masks.any(axis=(1, 2))):
+        if masks[i].all():
+            distances[i] = np.inf
+        elif row == column:
+            planar = cv2.distanceTransform(masks[i].astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            distances[i] = np.rint(planar.astype(np.float64) ** 2)
+        else:
+            distances[i] = ndimage.distance_transform_edt(masks[i], sampling=pixel_spacing) ** 2
+    return distances, row * row if row == column else 1.0
+
+
+def margin(mask, distance, spacing):
+    # Expansion (distance > 0) or contraction (distance < 0) by a sphere of that many mm, with (z, row, column) mm per
+    # voxel and Euclidean distances between voxel centres. Each slice is combined with the exact in-plane distance
+    # maps of the slices within reach, using the radius of the sphere's section at that slice offset. Only the
+    # bounding box of the ROI grown by the margin is processed.
+    if not mask.bits or distance == 0:
+        return SparseMask.from_state(mask.shape, mask.state())
+    radius = abs(distance)
+    z_spacing, row, column = spacing
+    box = mask.box()
+    if distance > 0:
+        pad = np.array([math.ceil(radius / x) for x in spacing])
+        box[::2] = np.maximum(box[::2] - pad, 0)
+        box[1::2] = np.minimum(box[1::2] + pad, mask.shape)
+    dense = mask.dense(box)
+
+    if distance > 0:
+        distances, scale = planar_distances(~dense, (row, column))
+    else:
+        # Outside the series counts as outside the ROI, so contraction also works from the edges of the scan.
+        distances, scale = planar_distances(np.pad(dense, ((0, 0), (1, 1), (1, 1))), (row, column))
+        distances = distances[:, 1:-1, 1:-1]
+
+    reach = int(radius // z_spacing)
+    result = dense.copy()
+    for i in range(len(dense)):
+        for offset in range(-reach, reach + 1):
+            limit = radius * radius - (offset * z_spacing) ** 2
+            j = i + offset
+            if distance > 0:
+                if 0 <= j < len(dense):
+                    result[i] |= distances[j] * scale <= limit
+            elif 0 <= j < len(dense):
+                result[i] &= distances[j] * scale > limit
+            else:
+                result[i] = False
+    return SparseMask.from_dense(result, mask.shape, box)
+
+
+def outlines(mask):
+    # Boundary polygons of every slice in pixel coordinates, in the layout of volume.contours.
+    contours = {}
+    for n in mask.slices():
+        top, _, left, _, cropped = mask.crop(n)
+        found, _ = cv2.findContours(cropped.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE,
+                                    offset=(int(left), int(top)))
+        contours[n] = [x.astype(np.float64) for x in found]
+    return contours
+
+
+def spacing(volume):
+    return (volume.slice_thickness(), *(float(x) for x in volume.spacings[0]))
+
+
+@timed("derive_structure")
+def derive(volume, operation, names, distance=0):
+    # Mask of a structure derived from existing ROIs. Difference removes every further ROI from the first one.
+    masks = [volume.masks[name] for name in names]
+    if operation == "Union":
+        return union(masks)
+    if operation == "Intersection":
+        return intersection(masks)
+    if operation == "Difference":
+        return difference(masks[0], masks[1:])
+    if operation == "Margin":
+        return margin(masks[0], distance, spacing(volume))
+    raise ValueError(f"Unknown operation {operation}")
+
+
+def add_structure(volume, name, mask):
+    volume.masks[name] = mask
+    volume.contours[name] = outlines(mask)
+    return contour_properties(volume, [name])[name]
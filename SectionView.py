@@ -0,0 +1,55 @@
+from PySide6.QtCore import Qt, QSize, Signal
+from PySide6.QtGui import QImage, QPixmap
+from PySide6.QtWidgets import QWidget, QLabel, QSlider, QVBoxLayout
+
+# Tab name and Volume.section axis of the resliced views.
+PLANES = (("Coronal", 1), ("Sagittal", 2))
+
+
+def scaled_pixmap(image, size, aspect=1.0):
+    # RGBA image fitted into size, with every pixel shown aspect times as high as it is wide.
+    height, width = image.shape[:2]
+    pixmap = QPixmap.fromImage(QImage(image.data, width, height, width * 4, QImage.Format_RGBA8888))
+    target = QSize(width, max(round(height * aspect), 1)).scaled(size, Qt.KeepAspectRatio)
+    return pixmap.scaled(target, Qt.IgnoreAspectRatio)
+
+
+class SectionView(QWidget):
+    # A coronal or sagittal plane through the open series with its own slider.
+    changed = Signal()
+
+    def __init__(self, axis, parent=None):
+        super().__init__(parent)
+        self.axis = axis
+        self.value = 0
+        self.overlay = None
+
+        self.preview = QLabel()
+        self.preview.setMinimumHeight(500)
+        self.preview.setMinimumWidth(500)
+        self.preview.setAlignment(Qt.AlignCenter)
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.setMinimum(0)
+        self.slider.valueChanged.connect(self.change_plane)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.preview)
+        layout.addWidget(self.slider)
+        self.setLayout(layout)
+
+    def reset(self, length, overlay):
+        # Starts in the middle of a newly shown series.
+        self.overlay = overlay
+        self.value = length // 2
+        self.slider.blockSignals(True)
+        self.slider.setMaximum(length - 1)
+        self.slider.setValue(self.value)
+        self.slider.blockSignals(False)
+
+    def change_plane(self, value):
+        self.value = value
+        self.changed.emit()
+
+    def show_image(self, image, aspect):
+        self.preview.setPixmap(scaled_pixmap(image, self.preview.size(), aspect))
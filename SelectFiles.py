@@ -1,56 +1,25 @@
-from pydicom.errors import InvalidDicomError
-from PySide6.QtCore import QDir, Qt, Slot, Signal
+from PySide6.QtCore import QDir, Qt, Slot, Signal, QThreadPool
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QPushButton, QLabel, QListWidget, \
     QListWidgetItem, QMessageBox
-from pydicom import read_file
-from collections import defaultdict
-
-
-class Frame:
-    def __init__(self, x, rt_struct=False):
-
-        self.file = read_file(x)
-        self.sup_uid = self.file.SOPInstanceUID
-
-        self.raw_img = None
-        self.rescale_slope = None
-        self.rescale_intercept = None
-        self.hu_img = None
-
-        self.num_contours = None
-        self.contours_names = None
-        self.contours_sequences = None
-        self.contours_properties = None
-
-        self.contours_masks = None
-        self.contours = None
-        self.z = None
-
-        if not rt_struct:
-            self.raw_img = self.file.pixel_array
-            self.rescale_slope = self.file.RescaleSlope
-            self.rescale_intercept = self.file.RescaleIntercept
-            self.hu_img = self.raw_img * self.rescale_slope + self.rescale_intercept
-            self.contours = defaultdict(list)
-            self.contours_masks = {}
-            self.z = self.file.ImagePositionPatient[-1]
-        else:
-            self.num_contours = len(self.file.StructureSetROISequence)
-            self.contours_names = [self.file.StructureSetROISequence[i].ROIName for i in range(self.num_contours)]
-            self.contours_sequences = [self.file.ROIContourSequence[i].ContourSequence for i in range(self.num_contours)]
-            self.contours_properties = {}
 
 
 class SelectFiles(QWidget):
     success = Signal()
     failure = Signal()
 
-    def __init__(self):
+    rt_struct = False
+
+    def __init__(self, pool=None):
         super().__init__()
 
+        self.pool = pool if pool is not None else QThreadPool.globalInstance()
+        self.reader = None
+        self.datasets = {}
+
         self.files = None
         self.selected_directory = None
         self.selected_files = None
+        self.selected_datasets = None
 
         self.setWindowTitle("MaksContours - select CT files")
         self.setMinimumWidth(600)
@@ -98,17 +67,31 @@ class SelectFiles(QWidget):
             message.setInformativeText("No files selected!")
             message.exec()
         else:
-            for index in indices:
-                try:
-                    Frame(self.files[index].absoluteFilePath())
-                except InvalidDicomError:
-                    message = QMessageBox()
-                    message.setText("Error!")
-                    message.setInformativeText(f"Invalid file: {self.files[index].absoluteFilePath()}")
-                    message.exec()
-                    return
-            self.selected_files = [self.files[i].absoluteFilePath() for i in indices]
-            self.success.emit()
+            self.validate([self.files[i].absoluteFilePath() for i in indices])
+
+    def validate(self, paths):
+        from Loader import HeaderReader
+
+        self.buttonAccept.setEnabled(False)
+        self.reader = HeaderReader(self.pool, paths, self.datasets, self.rt_struct)
+        self.reader.finished.connect(self.files_validated)
+        self.reader.failed.connect(self.validation_failed)
+        self.reader.start()
+
+    @Slot()
+    def files_validated(self, datasets):
+        self.buttonAccept.setEnabled(True)
+        self.selected_files = self.reader.paths
+        self.selected_datasets = datasets
+        self.success.emit()
+
+    @Slot()
+    def validation_failed(self, path):
+        self.buttonAccept.setEnabled(True)
+        message = QMessageBox()
+        message.setText("Error!")
+        message.setInformativeText(f"Invalid file: {path}")
+        message.exec()
 
     @Slot()
     def back(self):
@@ -116,8 +99,10 @@ class SelectFiles(QWidget):
 
 
 class SelectContour(SelectFiles):
-    def __init__(self):
-        super().__init__()
+    rt_struct = True
+
+    def __init__(self, pool=None):
+        super().__init__(pool)
 
         self.setWindowTitle("MaksContours - select contour file")
         self.label.setText("Select file containing contours:")
@@ -150,14 +135,11 @@ class SelectContour(SelectFiles):
             message.setInformativeText("Select only one file!")
             message.exec()
         else:
-            for index in indices:
-                try:
-                    Frame(self.files[index].absoluteFilePath(), True)
-                except InvalidDicomError:
-                    message = QMessageBox()
-                    message.setText("Error!")
-                    message.setInformativeText(f"Invalid file: {self.files[index].absoluteFilePath()}")
-                    message.exec()
-                    return
-            self.selected_files = self.files[indices[0]].absoluteFilePath()
-            self.success.emit()
+            self.validate([self.files[indices[0]].absoluteFilePath()])
+
+    @Slot()
+    def files_validated(self, datasets):
+        self.buttonAccept.setEnabled(True)
+        self.selected_files = self.reader.paths[0]
+        self.selected_datasets = datasets[0]
+        self.success.emit()
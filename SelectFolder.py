@@ -1,13 +1,18 @@
-from PySide6.QtCore import QDir, Slot, Signal
+import os
+from PySide6.QtCore import QDir, QThreadPool, QTimer, Qt, Slot, Signal
 from PySide6.QtWidgets import QWidget, QFileSystemModel, QTreeView, QVBoxLayout, QPushButton, QLabel, \
-    QMessageBox
+    QMessageBox, QTreeWidget, QTreeWidgetItem
+from Settings import start_directory, remember_directory
 
 
 class SelectFolder(QWidget):
     success = Signal()
+    study_selected = Signal(list, str)
 
-    def __init__(self):
+    def __init__(self, pool=None):
         super().__init__()
+        self.pool = pool if pool is not None else QThreadPool.globalInstance()
+        self.scanner = None
         self.selected_directory = None
 
         self.setWindowTitle("MaksContours - select CT folder")
@@ -15,31 +20,62 @@ class SelectFolder(QWidget):
 
         self.layout = QVBoxLayout()
 
-        self.model = QFileSystemModel()
-        self.model.setFilter(QDir.NoDotAndDotDot | QDir.AllDirs)
-        self.model.setRootPath(QDir.rootPath())
+        self.model = None
+        self.start_directory = QDir.cleanPath(start_directory())
 
         self.tree = QTreeView()
-        self.tree.setModel(self.model)
         self.tree.setMinimumWidth(600)
         self.tree.setMinimumHeight(600)
-        self.tree.setColumnWidth(0, 300)
-        self.tree.setRootIndex(self.model.index(QDir.rootPath()))
-        # self.tree.setCurrentIndex(self.model.index(QDir.homePath()))
-        self.tree.setCurrentIndex(self.model.index("C:\\Users\\Maks\\Downloads\\CT_nowa\\CT_nowa\\Pacjent"))
-        # self.tree.setCurrentIndex(self.model.index("C:\\Users\\Maks\\OneDrive\\MaksContours\\CT_07.10.2020"))
-        # self.tree.setCurrentIndex(self.model.index("/Users/maks/Library/CloudStorage/OneDrive-Osobisty/MaksContours/CT_07.10.2020"))
 
         self.buttonSelect = QPushButton('Select CT')
         self.buttonSelect.clicked.connect(self.select_directory)
 
+        self.studies_label = QLabel("Studies in the selected folder:")
+        self.studies = QTreeWidget()
+        self.studies.setColumnCount(3)
+        self.studies.setHeaderLabels(["Patient / CT series", "Slices", "RT struct"])
+        self.studies.setColumnWidth(0, 300)
+        self.studies.itemDoubleClicked.connect(self.open_study)
+
+        self.buttonScan = QPushButton("Find studies")
+        self.buttonScan.clicked.connect(self.scan_directory)
+        self.buttonOpen = QPushButton("Open study")
+        self.buttonOpen.clicked.connect(self.open_study)
+
         self.layout.addWidget(self.label)
         self.layout.addWidget(self.tree)
         self.layout.addWidget(self.buttonSelect)
+        self.layout.addWidget(self.studies_label)
+        self.layout.addWidget(self.studies)
+        self.layout.addWidget(self.buttonScan)
+        self.layout.addWidget(self.buttonOpen)
         self.setLayout(self.layout)
 
+        # The model is only attached once the window is on screen; it lists directories in its own thread and
+        # watches the start folder instead of the whole file system, so slow or network drives do not block.
+        QTimer.singleShot(0, self.populate_tree)
+
+    @Slot()
+    def populate_tree(self):
+        self.model = QFileSystemModel()
+        self.model.setFilter(QDir.NoDotAndDotDot | QDir.AllDirs)
+        self.model.directoryLoaded.connect(self.directory_loaded)
+        self.model.setRootPath(self.start_directory)
+
+        self.tree.setModel(self.model)
+        self.tree.setColumnWidth(0, 300)
+        self.tree.setRootIndex(self.model.index(QDir.rootPath()))
+        self.tree.setCurrentIndex(self.model.index(self.start_directory))
+
+    @Slot()
+    def directory_loaded(self, path):
+        if path == self.start_directory:
+            self.tree.scrollTo(self.tree.currentIndex())
+
     @Slot()
     def select_directory(self):
+        if self.model is None:
+            return
         entry = self.tree.currentIndex()
         self.selected_directory = self.model.filePath(entry)
         if QDir(self.selected_directory).isEmpty(QDir.Files):
@@ -48,4 +84,75 @@ class SelectFolder(QWidget):
             message.setInformativeText("The selected directory is empty!")
             message.exec()
         else:
+            remember_directory(self.selected_directory)
             self.success.emit()
+
+    @Slot()
+    def scan_directory(self):
+        # Headers of new or modified files are read in the background and kept in the study index, so scanning
+        # the same archive again only checks file sizes and modification times.
+        from Loader import StudyScanner
+
+        if self.model is None:
+            return
+        if self.scanner is not None:
+            self.scanner.cancel()
+        directory = self.model.filePath(self.tree.currentIndex()) or self.start_directory
+        self.studies_label.setText(f"Scanning {directory}...")
+        self.buttonScan.setEnabled(False)
+
+        self.scanner = StudyScanner(self.pool, directory)
+        self.scanner.progress.connect(self.scan_progress)
+        self.scanner.finished.connect(self.scan_finished)
+        self.scanner.failed.connect(self.scan_failed)
+        self.scanner.start()
+
+    @Slot()
+    def scan_progress(self, done, total):
+        if self.scanner is not None:
+            self.studies_label.setText(f"Scanning {self.scanner.root}: {done}/{total} files read")
+
+    @Slot()
+    def scan_finished(self, series):
+        self.studies_label.setText(f"Studies in {self.scanner.root}:")
+        self.scanner = None
+        self.buttonScan.setEnabled(True)
+
+        self.studies.clear()
+        patients = {}
+        for x in series:
+            key = (x.patient_name, x.patient_id)
+            if key not in patients:
+                patients[key] = QTreeWidgetItem([f"{x.patient_name} ({x.patient_id})"])
+                self.studies.addTopLevelItem(patients[key])
+            for structure in x.structures or [None]:
+                item = QTreeWidgetItem([x.description or x.uid, str(len(x.paths)),
+                                        os.path.basename(structure) if structure else "-"])
+                item.setData(0, Qt.UserRole, (x.paths, structure))
+                patients[key].addChild(item)
+        self.studies.expandAll()
+
+    @Slot()
+    def scan_failed(self, text):
+        self.scanner = None
+        self.buttonScan.setEnabled(True)
+        self.studies_label.setText("Studies in the selected folder:")
+        message = QMessageBox()
+        message.setText("Error!")
+        message.setInformativeText(text)
+        message.exec()
+
+    @Slot()
+    def open_study(self):
+        item = self.studies.currentItem()
+        study = item.data(0, Qt.UserRole) if item is not None else None
+        if study is None:
+            return
+        paths, structure = study
+        if structure is None:
+            message = QMessageBox()
+            message.setText("Error!")
+            message.setInformativeText("No RT struct refers to this CT series!")
+            message.exec()
+            return
+        self.study_selected.emit(paths, structure)
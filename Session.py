@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from Settings import MEMORY_BUDGET
+
+
+class Study:
+    __slots__ = ("key", "name", "volume", "contour_frame", "display", "overlay", "rows", "value")
+
+    def __init__(self, key, name, volume, contour_frame, display, overlay):
+        self.key = key
+        self.name = name
+        self.volume = volume
+        self.contour_frame = contour_frame
+        self.display = display
+        self.overlay = overlay
+        # ID, color and visibility of every table row, saved when another study is shown.
+        self.rows = []
+        self.value = 0
+
+    def memory(self):
+        return self.volume.memory() + self.display.memory()
+
+    def release(self):
+        # Drops rendered slices and moves pixel data and masks to disk; returns the bytes freed.
+        before = self.memory()
+        self.display.clear()
+        self.overlay = None
+        self.volume.spill()
+        return before - self.memory()
+
+
+class Session:
+    # Open studies in least recently used order. Activating a study brings its data back into RAM, and the least
+    # recently used other studies are released until the total fits the budget.
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.budget = budget
+        self.studies = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.studies
+
+    def __len__(self):
+        return len(self.studies)
+
+    def add(self, study):
+        self.studies[study.key] = study
+        return self.activate(study.key)
+
+    def activate(self, key):
+        study = self.studies[key]
+        self.studies.move_to_end(key)
+        study.volume.restore()
+        self.enforce()
+        return study
+
+    def close(self, key):
+        study = self.studies.pop(key)
+        study.display.clear()
+        return study
+
+    def memory(self):
+        return sum(study.memory() for study in self.studies.values())
+
+    def enforce(self):
+        total = self.memory()
+        for study in list(self.studies.values())[:-1]:
+            if total <= self.budget:
+                break
+            total -= study.release()
@@ -0,0 +1,41 @@
+import os
+from PySide6.QtCore import QDir, QSettings
+
+# Window presets as (level, width) in HU.
+WINDOW_PRESETS = {
+    "Full range": (1023.5, 4095),
+    "Soft tissue": (40, 400),
+    "Lung": (-600, 1500),
+    "Bone": (400, 1800),
+}
+
+# Set to a directory to open the folder browser there instead of the last used folder.
+START_VARIABLE = "MAKSCONTOURS_START_DIR"
+# Set to a number of MB to change how much pixel data and masks of open studies are kept in RAM.
+MEMORY_VARIABLE = "MAKSCONTOURS_MEMORY_BUDGET"
+MEMORY_BUDGET = 4 * 1024 ** 3
+
+
+def settings():
+    return QSettings("MaksContours", "MaksContours")
+
+
+def start_directory():
+    # The configured folder, else the last selected one, else home; missing folders are skipped.
+    candidates = (os.environ.get(START_VARIABLE), settings().value("recent_directory"), QDir.homePath())
+    for directory in candidates:
+        if directory and os.path.isdir(directory):
+            return directory
+    return QDir.homePath()
+
+
+def remember_directory(directory):
+    settings().setValue("recent_directory", directory)
+
+
+def memory_budget():
+    value = os.environ.get(MEMORY_VARIABLE, settings().value("memory_budget_mb"))
+    try:
+        return int(float(value) * 1024 ** 2) if value else MEMORY_BUDGET
+    except ValueError:
+        return MEMORY_BUDGET
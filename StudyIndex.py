@@ -0,0 +1,171 @@
+import os
+import sqlite3
+from pydicom import read_file
+from pydicom.errors import InvalidDicomError
+from Cache import cache_directory
+from Frame import DEFER_SIZE
+
+INDEX_NAME = "studies.sqlite"
+# Rows written per transaction while scanning; also how often progress is reported.
+BATCH_SIZE = 200
+
+COLUMNS = ("modality", "patient_id", "patient_name", "study_uid", "study_description", "series_uid",
+           "series_description", "sop_uid", "frame_uid", "referenced_frame_uid", "referenced_series_uid",
+           "referenced_sop_uid")
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    {", ".join(f"{column} TEXT" for column in COLUMNS)}
+);
+CREATE INDEX IF NOT EXISTS files_series ON files (series_uid);
+"""
+
+
+def is_dicom(path):
+    # Part 10 files start with a 128 byte preamble followed by "DICM".
+    try:
+        with open(path, "rb") as file:
+            file.seek(128)
+            return file.read(4) == b"DICM"
+    except OSError:
+        return False
+
+
+def read_entry(path):
+    dataset = read_file(path, defer_size=DEFER_SIZE, stop_before_pixels=True)
+    entry = {"modality": dataset.get("Modality"), "patient_id": dataset.get("PatientID"),
+             "patient_name": str(dataset.get("PatientName", "")), "study_uid": dataset.get("StudyInstanceUID"),
+             "study_description": dataset.get("StudyDescription"), "series_uid": dataset.get("SeriesInstanceUID"),
+             "series_description": dataset.get("SeriesDescription"), "sop_uid": dataset.get("SOPInstanceUID"),
+             "frame_uid": dataset.get("FrameOfReferenceUID")}
+    if entry["modality"] == "RTSTRUCT":
+        # The referenced CT series, its frame of reference and one of its slices, in order of reliability.
+        for frame in dataset.get("ReferencedFrameOfReferenceSequence", []):
+            entry["referenced_frame_uid"] = frame.get("FrameOfReferenceUID")
+            for study in frame.get("RTReferencedStudySequence", []):
+                for series in study.get("RTReferencedSeriesSequence", []):
+                    entry["referenced_series_uid"] = series.get("SeriesInstanceUID")
+                    for image in series.get("ContourImageSequence", [])[:1]:
+                        entry["referenced_sop_uid"] = image.get("ReferencedSOPInstanceUID")
+    return {column: None if entry.get(column) is None else str(entry[column]) for column in COLUMNS}
+
+
+class Series:
+    __slots__ = ("uid", "patient_id", "patient_name", "study_uid", "study_description", "description", "frame_uid",
+                 "paths", "structures")
+
+    def __init__(self, row):
+        self.uid = row["series_uid"]
+        self.patient_id = row["patient_id"]
+        self.patient_name = row["patient_name"]
+        self.study_uid = row["study_uid"]
+        self.study_description = row["study_description"]
+        self.description = row["series_description"]
+        self.frame_uid = row["frame_uid"]
+        self.paths = []
+        self.structures = []
+
+
+class StudyIndex:
+    def __init__(self, path=None):
+        self.path = path if path is not None else os.path.join(cache_directory(), INDEX_NAME)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def under(root):
+        # Range condition matching every path inside root; LIKE would treat "_" and "%" in folder names as wildcards.
+        prefix = os.path.join(os.path.abspath(root), "")
+        return "path >= ? AND path < ?", (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+    def scan(self, root, progress=None, is_cancelled=None):
+        # Only files that are new or whose size or modification time changed are read again. Files that are not
+        # DICOM are recorded too, so they are not opened on the next scan.
+        condition, parameters = self.under(root)
+        known = {row["path"]: (row["mtime_ns"], row["size"]) for row in
+                 self.connection.execute(f"SELECT path, mtime_ns, size FROM files WHERE {condition}", parameters)}
+
+        changed = []
+        seen = set()
+        for directory, _, files in os.walk(os.path.abspath(root)):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+                if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+                    changed.append((path, stat))
+            if is_cancelled is not None and is_cancelled():
+                return 0
+
+        with self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", [(x,) for x in known.keys() - seen])
+
+        rows = []
+        for i, (path, stat) in enumerate(changed, 1):
+            if is_cancelled is not None and is_cancelled():
+                break
+            entry = dict.fromkeys(COLUMNS)
+            if is_dicom(path):
+                try:
+                    entry = read_entry(path)
+                except (InvalidDicomError, OSError, ValueError, AttributeError):
+                    pass
+            rows.append((path, stat.st_mtime_ns, stat.st_size, *(entry[column] for column in COLUMNS)))
+            if len(rows) == BATCH_SIZE or i == len(changed):
+                self.write(rows)
+                rows = []
+                if progress is not None:
+                    progress(i, len(changed))
+        self.write(rows)
+        return len(changed)
+
+    def write(self, rows):
+        if not rows:
+            return
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO files (path, mtime_ns, size, {', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' * (len(COLUMNS) + 3))})", rows)
+
+    def series(self, root):
+        # CT series under root with the RT structure sets linked to each of them.
+        condition, parameters = self.under(root)
+        rows = self.connection.execute(
+            f"SELECT * FROM files WHERE {condition} AND modality IN ('CT', 'RTSTRUCT') ORDER BY path", parameters)
+
+        series = {}
+        slices = {}
+        structures = []
+        for row in rows:
+            if row["modality"] == "RTSTRUCT":
+                structures.append(row)
+                continue
+            if row["series_uid"] not in series:
+                series[row["series_uid"]] = Series(row)
+            series[row["series_uid"]].paths.append(row["path"])
+            slices[row["sop_uid"]] = row["series_uid"]
+
+        for row in structures:
+            uid = row["referenced_series_uid"]
+            if uid not in series:
+                uid = slices.get(row["referenced_sop_uid"])
+            if uid is None:
+                candidates = [x.uid for x in series.values()
+                              if x.frame_uid == row["referenced_frame_uid"] and x.study_uid == row["study_uid"]]
+                uid = candidates[0] if len(candidates) == 1 else None
+            if uid is not None:
+                series[uid].structures.append(row["path"])
+
+        return sorted(series.values(), key=lambda x: (x.patient_name or "", x.patient_id or "", x.study_uid or "",
+                                                      x.description or ""))
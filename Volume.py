@@ -0,0 +1,116 @@
+import copy
+import tempfile
+import numpy as np
+
+# Series larger than this are backed by a temporary memory-mapped file instead of RAM.
+MEMMAP_THRESHOLD = 2 * 1024 ** 3
+# Axes of the planes returned by Volume.section.
+AXIAL, CORONAL, SAGITTAL = 0, 1, 2
+
+
+class Volume:
+    __slots__ = ("pixels", "loaded", "slopes", "intercepts", "origins", "orientations", "spacings", "z", "uids",
+                 "datasets", "contours", "masks", "backing", "spill_file")
+
+    def __init__(self, datasets, backing=None):
+        datasets = sorted(datasets, key=lambda x: float(x.ImagePositionPatient[-1]))
+        first = datasets[0]
+        shape = (len(datasets), int(first.Rows), int(first.Columns))
+        dtype = np.dtype(f"{'i' if first.PixelRepresentation else 'u'}{max(int(first.BitsAllocated) // 8, 1)}")
+
+        if backing is None and np.prod(shape) * dtype.itemsize > MEMMAP_THRESHOLD:
+            backing = tempfile.TemporaryFile()
+        self.backing = backing
+        if backing is None:
+            self.pixels = np.zeros(shape, dtype=dtype)
+        else:
+            self.pixels = np.memmap(backing, dtype=dtype, mode="w+", shape=shape)
+        self.loaded = np.zeros(shape[0], dtype=bool)
+
+        self.slopes = np.array([float(x.get("RescaleSlope", 1)) for x in datasets])
+        self.intercepts = np.array([float(x.get("RescaleIntercept", 0)) for x in datasets])
+        self.origins = np.array([[float(v) for v in x.ImagePositionPatient] for x in datasets])
+        self.orientations = np.array([[float(v) for v in x.ImageOrientationPatient] for x in datasets])
+        self.spacings = np.array([[float(v) for v in x.PixelSpacing] for x in datasets])
+        self.z = self.origins[:, -1].copy()
+        self.uids = [x.SOPInstanceUID for x in datasets]
+
+        # Parsed headers with deferred pixel data, shared with the file selector.
+        self.datasets = datasets
+
+        self.contours = {}
+        self.masks = {}
+        self.spill_file = None
+
+    def __len__(self):
+        return self.pixels.shape[0]
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+    def read_slice(self, n):
+        # Decode through a shallow copy so the deferred pixel data is not cached on the shared header.
+        self.pixels[n] = copy.copy(self.datasets[n]).pixel_array
+        self.loaded[n] = True
+
+    def section(self, axis, n):
+        # Plane n across the given axis as a strided view of the pixels, without copying. Coronal (fixed row) and
+        # sagittal (fixed column) planes have one row per slice, last slice first so the head is at the top.
+        if axis == AXIAL:
+            return self.pixels[n]
+        if axis == CORONAL:
+            return self.pixels[::-1, n]
+        return self.pixels[::-1, :, n]
+
+    def aspect(self, axis):
+        # Height over width in mm of one pixel of a plane across the given axis.
+        row, column = self.spacings[0]
+        if axis == AXIAL:
+            return row / column
+        return self.slice_thickness() / (column if axis == CORONAL else row)
+
+    def memory(self):
+        # Bytes of pixel data and masks held in RAM rather than in a file mapping.
+        pixels = 0 if isinstance(self.pixels, np.memmap) else self.pixels.nbytes
+        masks = 0 if self.spill_file is not None else sum(mask.nbytes for mask in self.masks.values())
+        return pixels + masks
+
+    def spill(self):
+        # Moves the pixel data and the packed masks to one temporary file mapped in their place, so they are read
+        # back page by page when accessed and restore() brings them back into RAM.
+        if self.spill_file is not None:
+            return
+        states = [(mask, mask.state()) for mask in self.masks.values()]
+        in_memory = not isinstance(self.pixels, np.memmap)
+        size = (self.pixels.nbytes if in_memory else 0) + sum(state["bits"].nbytes for _, state in states)
+
+        self.spill_file = tempfile.TemporaryFile()
+        buffer = np.memmap(self.spill_file, dtype=np.uint8, mode="w+", shape=(max(size, 1),))
+        start = 0
+        if in_memory:
+            pixels = buffer[:self.pixels.nbytes].view(self.pixels.dtype).reshape(self.pixels.shape)
+            pixels[:] = self.pixels
+            self.pixels = pixels
+            start = self.pixels.nbytes
+        for mask, state in states:
+            bits = buffer[start:start + state["bits"].nbytes]
+            bits[:] = state["bits"]
+            state["bits"] = bits
+            mask.bits = type(mask).from_state(mask.shape, state).bits
+            start += bits.nbytes
+        buffer.flush()
+
+    def restore(self):
+        if self.spill_file is None:
+            return
+        if self.backing is None:
+            self.pixels = np.array(self.pixels)
+        for mask in self.masks.values():
+            mask.bits = {n: np.array(x) for n, x in mask.bits.items()}
+        self.spill_file = None
+
+    def slice_thickness(self):
+        if len(self) > 1:
+            return float(np.median(np.abs(np.diff(self.z))))
+        return float(self.datasets[0].get("SliceThickness") or 1)
@@ -0,0 +1,104 @@
+import argparse
+import sys
+import tempfile
+import numpy as np
+from Frame import Frame, read_header
+from Masks import ContourIndex, SparseMask, rasterize_slice
+from RoiAlgebra import union, intersection, difference
+from Volume import Volume
+from benchmarks.synthetic import generate_study
+
+
+def reference_slice(slice_contours, shape):
+    # The original rasterization: skimage's points_in_poly for every pixel of each contour's bounding box grown by
+    # one pixel, counted per contour, then even-odd.
+    from skimage.measure import points_in_poly
+
+    mask = np.zeros(shape, dtype=np.int32)
+    for contour in slice_contours:
+        left = int(np.amin(contour[:, 0])) - 1
+        right = int(np.amax(contour[:, 0])) + 1
+        top = int(np.amin(contour[:, 1])) - 1
+        bottom = int(np.amax(contour[:, 1])) + 1
+        y, x = np.mgrid[top:bottom, left:right]
+        inside = points_in_poly(np.column_stack((x.ravel(), y.ravel())), contour)
+        mask[top:bottom, left:right] += inside.reshape(y.shape)
+    return mask % 2 == 1
+
+
+def check_rasterization(slices=20, size=128, rois=12, seed=0):
+    # Scanline fill against the original on the contours of a synthetic RT struct, read like a real one: convex,
+    # concave, holed and split ROIs with non-integer vertices.
+    with tempfile.TemporaryDirectory() as directory:
+        paths, structure_path = generate_study(directory, slices, size, rois, seed=seed)
+        volume = Volume([read_header(path) for path in paths])
+        index = ContourIndex(Frame(read_header(structure_path, True)), volume)
+
+    failures = 0
+    total = 0
+    for name in index.contours:
+        for slice_contours in index.slices(name).values():
+            (top, left), mask = rasterize_slice(slice_contours, volume.shape[1:])
+            result = np.zeros(volume.shape[1:], dtype=bool)
+            result[top:top + mask.shape[0], left:left + mask.shape[1]] = mask
+            failures += not np.array_equal(result, reference_slice(slice_contours, volume.shape[1:]))
+            total += 1
+    return failures, total
+
+
+def random_mask(shape, rng):
+    # Blocks at random places, so masks of one case overlap partly, fully or not at all.
+    mask = np.zeros(shape, dtype=bool)
+    for _ in range(rng.integers(1, 4)):
+        corner = [rng.integers(0, x) for x in shape]
+        size = [rng.integers(1, x + 1) for x in shape]
+        mask[tuple(slice(c, c + s) for c, s in zip(corner, size))] = True
+    return mask
+
+
+def check_algebra(cases=200, seed=0):
+    # Union, intersection and difference of sparse masks against the same operations on dense arrays.
+    rng = np.random.default_rng(seed)
+    shape = (6, 20, 20)
+    # A first ROI inside the second one's box, and the other way round.
+    a = np.zeros(shape, dtype=bool)
+    b = np.zeros(shape, dtype=bool)
+    a[1, 2:8, 2:8] = True
+    b[1, 5:15, 5:15] = True
+    inputs = [[a, b], [b, a]] + [[random_mask(shape, rng) for _ in range(rng.integers(2, 4))] for _ in range(cases)]
+
+    failures = 0
+    for dense in inputs:
+        masks = [SparseMask.from_dense(x) for x in dense]
+        expected = {"union": np.logical_or.reduce(dense), "intersection": np.logical_and.reduce(dense),
+                    "difference": dense[0] & ~np.logical_or.reduce(dense[1:])}
+        results = {"union": union(masks), "intersection": intersection(masks),
+                   "difference": difference(masks[0], masks[1:])}
+        for operation, result in results.items():
+            if not np.array_equal(result.dense(), expected[operation]):
+                failures += 1
+    return failures, len(inputs) * 3
+
+
+CHECKS = {"rasterization": check_rasterization, "algebra": check_algebra}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare optimized mask operations against reference versions.")
+    parser.add_argument("checks", nargs="*", help=f"checks to run: {', '.join(CHECKS)} (default: all)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(sorted(unknown))}")
+
+    status = 0
+    for name in args.checks or CHECKS:
+        failures, total = CHECKS[name](seed=args.seed)
+        print(f"{name}: {total - failures}/{total} match")
+        status |= failures > 0
+    return int(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
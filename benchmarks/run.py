@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from PySide6.QtCore import QThreadPool
+from Display import Display
+from Dose import read_dose, dose_volume_histograms
+from Frame import Frame, read_header
+from Masks import ContourIndex, rasterize, contour_properties
+from Overlay import Overlay
+from Settings import WINDOW_PRESETS
+from Volume import Volume, SAGITTAL
+from benchmarks.synthetic import generate_study, generate_dose
+
+
+def run_stages(paths, structure_path, dose_path):
+    # The same steps the main window runs, timed one by one.
+    times = {}
+
+    start = time.perf_counter()
+    datasets = [read_header(path) for path in paths]
+    times["headers"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    volume = Volume(datasets)
+    for n in range(len(volume)):
+        volume.read_slice(n)
+    contour_frame = Frame(read_header(structure_path, True))
+    times["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = ContourIndex(contour_frame, volume)
+    names = contour_frame.contours_names
+    for name in names:
+        volume.contours[name] = {n: [contour.reshape(-1, 1, 2) for contour in slice_contours]
+                                 for n, slice_contours in index.slices(name).items()}
+    times["contour_matching"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for name in names:
+        volume.masks[name] = rasterize(index.slices(name), volume.shape)
+    times["rasterization"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    contour_properties(volume, names)
+    times["statistics"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dose_volume_histograms(volume, {name: volume.masks[name] for name in names}, read_dose(dose_path))
+    times["dvh"] = time.perf_counter() - start
+
+    display = Display(volume, QThreadPool.globalInstance(), *WINDOW_PRESETS["Soft tissue"])
+    overlay = Overlay(volume)
+    layers = [(name, (255, 0, 0, 255)) for name in names]
+    start = time.perf_counter()
+    for n in range(len(volume)):
+        overlay.compose(n, display.slice(n), layers)
+    times["rendering_per_slice"] = (time.perf_counter() - start) / len(volume)
+
+    start = time.perf_counter()
+    for n in range(len(volume)):
+        overlay.compose(n, display.slice(n), layers)
+    times["rendering_cached_per_slice"] = (time.perf_counter() - start) / len(volume)
+
+    overlay = Overlay(volume, axis=SAGITTAL)
+    start = time.perf_counter()
+    for n in range(volume.shape[SAGITTAL]):
+        overlay.compose(n, display.slice(n, SAGITTAL), layers)
+    times["rendering_sagittal_per_plane"] = (time.perf_counter() - start) / volume.shape[SAGITTAL]
+    return times
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every processing stage on a synthetic CT + RT struct study.")
+    parser.add_argument("--slices", type=int, default=100)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--rois", type=int, default=20)
+    parser.add_argument("--points", type=int, default=120, help="points per contour")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data", help="directory for the generated study (default: temporary)")
+    parser.add_argument("-o", "--output", help="JSON file for the results (default: standard output)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.data or temporary
+        start = time.perf_counter()
+        paths, structure_path = generate_study(directory, args.slices, args.size, args.rois, args.points, args.seed)
+        dose_path = generate_dose(directory, args.slices, args.size, seed=args.seed)
+        generation = time.perf_counter() - start
+
+        runs = [run_stages(paths, structure_path, dose_path) for _ in range(args.repeat)]
+
+    result = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "parameters": {"slices": args.slices, "size": args.size, "rois": args.rois, "points": args.points,
+                       "repeat": args.repeat, "seed": args.seed},
+        "generation": generation,
+        "stages": {stage: min(run[stage] for run in runs) for stage in runs[0]},
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# Modules that should not be imported before the first window is shown.
+DEFERRED_MODULES = ("cv2", "pydicom", "Frame", "Volume", "Loader", "Masks", "Cache", "Display", "Overlay", "Export")
+
+
+def measure():
+    # Runs in a fresh interpreter: time to import the application and to put the first window on screen.
+    start = time.perf_counter()
+    from PySide6.QtWidgets import QApplication
+    import MaksContours
+    imported = time.perf_counter()
+
+    app = QApplication([])
+    window = MaksContours.MainWindow()
+    app.processEvents()
+    shown = time.perf_counter()
+    window.folder_selector.close()
+
+    return {"import": imported - start, "first_window": shown - start,
+            "deferred_modules_loaded": [x for x in DEFERRED_MODULES if x in sys.modules]}
+
+
+def run_once(environment):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--child"], capture_output=True, text=True,
+                            check=True, cwd=root, env=environment).stdout
+    result = json.loads(output.splitlines()[-1])
+    result["process"] = time.perf_counter() - start
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the start of the application up to its first window.")
+    parser.add_argument("--repeat", type=int, default=5, help="interpreter starts, the fastest is reported")
+    parser.add_argument("--platform", default="offscreen", help="Qt platform plugin (default: offscreen)")
+    parser.add_argument("--limit", type=float, help="exit with status 1 if the first window takes longer (seconds)")
+    parser.add_argument("-o", "--output", help="JSON file for the results (default: standard output)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(measure()))
+        return 0
+
+    from benchmarks.run import commit
+
+    environment = dict(os.environ, QT_QPA_PLATFORM=args.platform)
+    runs = [run_once(environment) for _ in range(args.repeat)]
+    result = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "parameters": {"repeat": args.repeat, "platform": args.platform},
+        "stages": {stage: min(run[stage] for run in runs) for stage in ("process", "import", "first_window")},
+        "deferred_modules_loaded": sorted({x for run in runs for x in run["deferred_modules_loaded"]}),
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    if args.limit is not None and result["stages"]["first_window"] > args.limit:
+        print(f"First window took {result['stages']['first_window']:.3f} s, limit is {args.limit} s", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import os
+import numpy as np
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+RT_STRUCTURE_SET_STORAGE = "1.2.840.10008.5.1.4.1.1.481.3"
+RT_DOSE_STORAGE = "1.2.840.10008.5.1.4.1.1.481.2"
+SHAPES = ("convex", "concave", "holed", "islands")
+
+
+def new_dataset(sop_class, study_uid, frame_uid):
+    uid = generate_uid()
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = sop_class
+    dataset.SOPInstanceUID = uid
+    dataset.StudyInstanceUID = study_uid
+    dataset.FrameOfReferenceUID = frame_uid
+    dataset.PatientID = "SYNTHETIC"
+    dataset.PatientName = "Synthetic^Phantom"
+    return dataset
+
+
+def phantom(size, rng):
+    # Water ellipse with soft noise inside air, stored with the usual -1024 HU intercept.
+    y, x = np.mgrid[:size, :size]
+    body = ((x - size / 2) / (size * 0.42)) ** 2 + ((y - size / 2) / (size * 0.32)) ** 2 <= 1
+    image = np.where(body, 1024 + rng.normal(40, 30, (size, size)), rng.normal(0, 5, (size, size)))
+    return np.clip(image, 0, 4095).astype(np.uint16)
+
+
+def outline(shape, center, radius, points, phase):
+    t = np.linspace(0, 2 * np.pi, points, endpoint=False) + phase
+    if shape == "concave":
+        r = radius * (1 + 0.35 * np.sin(5 * t))
+    else:
+        r = radius * (1 + 0.05 * np.sin(3 * t))
+    return [np.stack([center[0] + r * np.cos(t), center[1] + r * np.sin(t)], axis=1)]
+
+
+def roi_polygons(shape, center, radius, points, phase):
+    # Polygons of one ROI on one slice, in mm relative to the slice origin.
+    if shape == "holed":
+        outer = outline("convex", center, radius, points, phase)[0]
+        inner = outline("convex", center, radius * 0.5, points // 2, phase)[0]
+        return [outer, inner[::-1]]
+    if shape == "islands":
+        offset = np.array([radius * 1.2, 0])
+        return (outline("convex", center - offset, radius * 0.5, points // 2, phase)
+                + outline("convex", center + offset, radius * 0.5, points // 2, phase))
+    return outline(shape, center, radius, points, phase)
+
+
+def generate_study(directory, slices=100, size=512, rois=20, points=120, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    study_uid = generate_uid()
+    series_uid = generate_uid()
+    frame_uid = generate_uid()
+    spacing = 500 / size
+    thickness = 2.5
+    origin = -spacing * size / 2
+
+    images = []
+    for n in range(slices):
+        dataset = new_dataset(CT_IMAGE_STORAGE, study_uid, frame_uid)
+        dataset.Modality = "CT"
+        dataset.SeriesInstanceUID = series_uid
+        dataset.InstanceNumber = n + 1
+        dataset.Rows = dataset.Columns = size
+        dataset.PixelSpacing = [spacing, spacing]
+        dataset.SliceThickness = thickness
+        dataset.ImagePositionPatient = [origin, origin, n * thickness]
+        dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        dataset.SamplesPerPixel = 1
+        dataset.PhotometricInterpretation = "MONOCHROME2"
+        dataset.BitsAllocated = dataset.BitsStored = 16
+        dataset.HighBit = 15
+        dataset.PixelRepresentation = 0
+        dataset.RescaleSlope = 1
+        dataset.RescaleIntercept = -1024
+        dataset.PixelData = phantom(size, rng).tobytes()
+        dataset.save_as(os.path.join(directory, f"CT{n + 1:04d}.dcm"), write_like_original=False)
+        images.append(dataset.SOPInstanceUID)
+
+    structure = new_dataset(RT_STRUCTURE_SET_STORAGE, study_uid, frame_uid)
+    structure.Modality = "RTSTRUCT"
+    structure.SeriesInstanceUID = generate_uid()
+    reference = Dataset()
+    reference.FrameOfReferenceUID = frame_uid
+    structure.ReferencedFrameOfReferenceSequence = [reference]
+
+    roi_sequence = []
+    contour_sequence = []
+    for i in range(rois):
+        shape = SHAPES[i % len(SHAPES)]
+        radius = rng.uniform(10, 60) if i else 180
+        center = rng.uniform(-120, 120, 2) if i else np.zeros(2)
+        first = int(rng.integers(0, max(slices // 2, 1))) if i else 0
+        last = int(rng.integers(first + 1, slices + 1)) if i else slices
+
+        roi = Dataset()
+        roi.ROINumber = i + 1
+        roi.ROIName = f"{shape.upper()}_{i + 1}" if i else "BODY"
+        roi.ReferencedFrameOfReferenceUID = frame_uid
+        roi_sequence.append(roi)
+
+        contours = []
+        for n in range(first, last):
+            for polygon in roi_polygons(shape, center, radius, points, n * 0.05):
+                contour = Dataset()
+                contour.ContourGeometricType = "CLOSED_PLANAR"
+                contour.NumberOfContourPoints = len(polygon)
+                xyz = np.column_stack([polygon, np.full(len(polygon), n * thickness)])
+                contour.ContourData = [f"{v:.3f}" for v in xyz.ravel()]
+                image = Dataset()
+                image.ReferencedSOPClassUID = CT_IMAGE_STORAGE
+                image.ReferencedSOPInstanceUID = images[n]
+                contour.ContourImageSequence = [image]
+                contours.append(contour)
+
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = i + 1
+        roi_contour.ROIDisplayColor = [int(v) for v in rng.integers(0, 256, 3)]
+        roi_contour.ContourSequence = contours
+        contour_sequence.append(roi_contour)
+
+    structure.StructureSetROISequence = roi_sequence
+    structure.ROIContourSequence = contour_sequence
+    structure.save_as(os.path.join(directory, "RS.synthetic.dcm"), write_like_original=False)
+    return [os.path.join(directory, f"CT{n + 1:04d}.dcm") for n in range(slices)], \
+        os.path.join(directory, "RS.synthetic.dcm")
+
+
+def generate_dose(directory, slices=100, size=512, prescription=60, seed=0):
+    # RT dose on a coarser 3 mm grid over the CT of generate_study: a Gaussian falloff around a point near the centre.
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    spacing = 3.0
+    extent = 500 / 2
+    x = np.arange(-extent + 1, extent, spacing)
+    z = np.arange(-2.0, slices * 2.5 + 2, spacing)
+    center = np.array([*rng.uniform(-40, 40, 2), slices * 2.5 / 2])
+    distance = ((x[None, None, :] - center[0]) ** 2 + (x[None, :, None] - center[1]) ** 2
+                + (z[:, None, None] - center[2]) ** 2)
+    dose = prescription * 1.05 * np.exp(-distance / (2 * 60 ** 2))
+    scaling = dose.max() / 65535
+
+    dataset = new_dataset(RT_DOSE_STORAGE, generate_uid(), generate_uid())
+    dataset.Modality = "RTDOSE"
+    dataset.SeriesInstanceUID = generate_uid()
+    dataset.Rows = dataset.Columns = len(x)
+    dataset.NumberOfFrames = len(z)
+    dataset.PixelSpacing = [spacing, spacing]
+    dataset.ImagePositionPatient = [x[0], x[0], z[0]]
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.GridFrameOffsetVector = list(z - z[0])
+    dataset.FrameIncrementPointer = 0x3004000C
+    dataset.DoseUnits = "GY"
+    dataset.DoseType = "PHYSICAL"
+    dataset.DoseSummationType = "PLAN"
+    dataset.DoseGridScaling = scaling
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.BitsAllocated = dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = np.rint(dose / scaling).astype(np.uint16).tobytes()
+    path = os.path.join(directory, "RD.synthetic.dcm")
+    dataset.save_as(path, write_like_original=False)
+    return path